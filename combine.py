@@ -4,51 +4,45 @@
 
 # pylama:ignore=E501,D213
 
+import argparse
 import collections
 import csv
 import datetime
+import html
 import json
+import mmap
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
-from bs4 import BeautifulSoup
+from common import ExternalSort, log, lines
+from ytcrawl.codec import decompress, split_name
+from ytcrawl.segstore import SegmentReader, list_segments, segment_name
 
-from common import log, lines, rel_path
+# The location of the crawled data and the API JSON output
+import config
 
-# Get the location of the crawled data and the API JSON output
-import do_crawl
-import do_api
-
-CRAWL_INPUT = os.path.join(do_crawl.OUTPUT_DIR, "data")
-API_FILE = do_api.OUTPUT_FILE
+CRAWL_INPUT = config.CRAWL_INPUT
+CRAWL_SEGMENTS = config.CRAWL_SEGMENTS
+API_FILE = config.API_FILE
 
 # We track all brag bar labels from the crawled output for display later
 ALL_BRAG_BAR = set()
 
 # Files that we write
-OUTPUT_DATA = rel_path("youtube-data.csv")
-OUTPUT_DAILIES = rel_path("youtube-daily-views.csv")
+OUTPUT_DATA = config.OUTPUT_DATA
+OUTPUT_DAILIES = config.OUTPUT_DAILIES
 
-DATA_COLS = [
-    "YouTubeID",
-    "WatchURL",
-    # From API "snippet"
-    "Title",
-    "Channel",
-    # From API statistics
-    "StatsCommentCount",
-    "StatsDislikeCount",
-    "StatsFavoriteCount",
-    "StatsLikeCount",
-    "StatsViewCount",
-    # From crawled brag bar
-    "BBShares",
-    "BBSubscriptions",
-    "BBViews",
-    "BBTimeWatched",
-    # From API "snippet"
-    "Description",
-    "Tags",
-]
+# Parsed results kept between runs by --incremental
+CACHE_FILE = config.CACHE_FILE
+
+# Defined with the API field of each column in config, which do_api.py reads
+DATA_COLS = [name for name, field in config.DATA_COLUMNS]
 
 DAILY_COLS = [
     "YouTubeID",
@@ -56,6 +50,27 @@ DAILY_COLS = [
     "ViewCount"
 ]
 
+# Column types for the Parquet and Arrow outputs; other columns are strings
+COLUMN_TYPES = {
+    "StatsCommentCount": "int64",
+    "StatsDislikeCount": "int64",
+    "StatsFavoriteCount": "int64",
+    "StatsLikeCount": "int64",
+    "StatsViewCount": "int64",
+    "BBShares": "int64",
+    "BBSubscriptions": "int64",
+    "BBViews": "int64",
+    "Day": "date",
+    "ViewCount": "int64",
+}
+
+# File extensions for each output format
+OUTPUT_EXTENSIONS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "arrow": ".arrows",
+}
+
 
 def ints(s):
     """Return a coreced int from the string unless s is empty."""
@@ -70,39 +85,81 @@ def normws(s):
     return ' '.join(s.strip().split())
 
 
+# Year-month-day strings by day number since the epoch: a corpus only
+# covers a few thousand distinct days
+DAY_NAMES = {}
+EPOCH = datetime.date(1970, 1, 1)
+
+
 def ts_to_day(ts):
     """Convert the JS-style timestamp to a year-month-day string."""
-    dt = datetime.datetime.utcfromtimestamp(int(ts) / 1000)
-    return dt.strftime("%Y-%m-%d")
+    return ts_to_days([ts])[0]
+
+
+def ts_to_days(timestamps):
+    """Convert a list of JS-style timestamps to year-month-day strings."""
+    names = [DAY_NAMES.get(int(ts) // 86400000) for ts in timestamps]
+    if None in names:
+        for i, ts in enumerate(timestamps):
+            if names[i] is None:
+                n = int(ts) // 86400000
+                names[i] = DAY_NAMES[n] = (EPOCH + datetime.timedelta(days=n)).strftime("%Y-%m-%d")
+    return names
+
 
+def extract(buffer, start_tag, end_tag, lo=0, hi=None):
+    """Extract the data bracketed by start_tag and end_tag.
 
-def extract(buffer, start_tag, end_tag):
-    """Extract the data bracketed by start_tag and end_tag."""
-    start = buffer.find(start_tag)
+    The buffer may also be UTF-8 bytes or an mmap, in which case only the
+    data found is decoded. Only buffer[lo:hi] is searched.
+    """
+    if hi is None:
+        hi = len(buffer)
+    if not isinstance(buffer, str):
+        start_tag, end_tag = start_tag.encode('ascii'), end_tag.encode('ascii')
+    start = buffer.find(start_tag, lo, hi)
     if start < 0:
         return ""
-    end = buffer.find(end_tag, start + len(start_tag))
+    end = buffer.find(end_tag, start + len(start_tag), hi)
     if end < start:
         raise ValueError("Invalid buffer found - found '%s' but not '%s'" % (start_tag, end_tag))
-    return buffer[start+len(start_tag):end].strip()
+    found = buffer[start+len(start_tag):end]
+    if not isinstance(found, str):
+        found = found.decode('utf-8')
+    return found.strip()
 
 
-def process_crawled(data):
+def process_crawled(data, lo=0, hi=None):
     """Extract all data from the single file contents.
 
+    The contents may be a str, or UTF-8 bytes or an mmap holding the
+    response at data[lo:hi]; see extract.
+
     Return is tuple of 2 dictionaries: (daily_stats, brag_bar)
     """
-    err_msg = extract(data, "<error_message><![CDATA[", "]]></error_message>")
+    err_msg = extract(data, "<error_message><![CDATA[", "]]></error_message>", lo, hi)
     if err_msg:
         log("  Skipping: %s", err_msg)
         return None, None
 
-    daily_stats = json.loads(extract(data, "<graph_data><![CDATA[", "]]></graph_data>"))
-    brag_bar_html = extract(data, "<html_content><![CDATA[", "]]></html_content>")
+    daily_stats = json.loads(extract(data, "<graph_data><![CDATA[", "]]></graph_data>", lo, hi))
+    brag_bar_html = extract(data, "<html_content><![CDATA[", "]]></html_content>", lo, hi)
     assert daily_stats
     assert brag_bar_html
 
+    brag_bar = bragbar_fast(brag_bar_html)
+    if brag_bar is None:
+        brag_bar = bragbar_soup(brag_bar_html)
+    ALL_BRAG_BAR.update(brag_bar)
+
+    return daily_stats, brag_bar
+
+
+def bragbar_soup(brag_bar_html):
+    """Return the brag bar {label: value} dict using BeautifulSoup."""
     brag_bar = {}
+    # only needed for HTML the fast parser doesn't recognize
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(brag_bar_html, 'html.parser')
     for td in soup.find_all("td"):
         if "stats-bragbar" not in td.get('class'):
@@ -115,35 +172,448 @@ def process_crawled(data):
                 value = ch.text
         if label and value:
             brag_bar[label] = value
-            ALL_BRAG_BAR.add(label)
+    return brag_bar
 
-    return daily_stats, brag_bar
 
+# For bragbar_fast: a table cell, an element holding only text, and a class.
+# Attributes are matched quote-aware, so a '>' in a quoted value is skipped.
+ATTRS = r'''((?:[^>"']|"[^"]*"|'[^']*')*)'''
+TD_OPEN_RE = re.compile(r'<td\b', re.I)
+CELL_RE = re.compile(r'<td\b' + ATTRS + r'>(.*?)</td\s*>', re.I | re.S)
+CHILD_RE = re.compile(r'\s*<(span|div)\b' + ATTRS + r'>([^<]*)</\1\s*>', re.I)
+CLASS_RE = re.compile(r'''(?:^|\s)class\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.I)
 
-def main():
-    """Entry point."""
+
+def _classes(attrs):
+    """Return the class list from a tag's attributes.
+
+    None if there is no class attribute or more than one, which the
+    caller leaves to BeautifulSoup.
+    """
+    found = CLASS_RE.findall(attrs)
+    if len(found) != 1:
+        return None
+    return "".join(found[0]).split()  # only one of the groups matched
+
+
+def bragbar_fast(brag_bar_html):
+    """Return the brag bar {label: value} dict without building a DOM.
+
+    Handles the shape YouTube sends: `stats-bragbar` cells whose children
+    are text-only span and div elements. Returns None for anything else
+    (nested tags or cells, comments, missing class attributes) so the
+    caller can fall back to bragbar_soup, which gives the same result.
+    """
+    if '<!' in brag_bar_html:
+        return None  # comments or CDATA: leave to the real parser
+
+    brag_bar = {}
+    cells = 0
+    for cell in CELL_RE.finditer(brag_bar_html):
+        cells += 1
+        cell_attrs, inner = cell.groups()
+        td_classes = _classes(cell_attrs)
+        if td_classes is None or TD_OPEN_RE.search(inner):
+            return None
+        if "stats-bragbar" not in td_classes:
+            continue
+
+        label, value = "", ""
+        pos = 0
+        for child in iter(lambda: CHILD_RE.match(inner, pos), None):
+            name, attrs, text = child.groups()
+            classes = _classes(attrs)
+            if classes is None:
+                return None
+            name = name.lower()
+            if name == "span" and "metric-label" in classes:
+                label = html.unescape(text)
+            elif name == "div" and "bragbar-metric" in classes:
+                value = html.unescape(text)
+            pos = child.end()
+        if inner[pos:].strip():
+            return None  # some other child: not a shape we know
+
+        if label and value:
+            brag_bar[label] = value
+
+    if cells != len(TD_OPEN_RE.findall(brag_bar_html)):
+        return None  # a cell without a closing tag
+    return brag_bar
+
+
+def verify_bragbar():
+    """Compare bragbar_fast with bragbar_soup on every crawled response.
+
+    Return is the number of responses where they disagree.
+    """
+    count, fallbacks, mismatches = 0, 0, 0
+    for ytid, data in crawled_files():
+        if extract(data, "<error_message><![CDATA[", "]]></error_message>"):
+            continue
+        brag_bar_html = extract(data, "<html_content><![CDATA[", "]]></html_content>")
+        count += 1
+        fast = bragbar_fast(brag_bar_html)
+        if fast is None:
+            fallbacks += 1
+            continue
+        soup = bragbar_soup(brag_bar_html)
+        if fast != soup:
+            mismatches += 1
+            log("Brag bar mismatch for [%s]: fast=%r soup=%r", ytid, fast, soup)
+    log("Verified brag bars: %d responses, %d fell back, %d mismatched", count, fallbacks, mismatches)
+    return mismatches
+
+
+def crawled_records():
+    """Yield (YouTube ID, payload, encoding) for every crawled response as stored.
+
+    Per-video files are read first, then segment files, so a video in both
+    takes its segment (newer) record.
+    """
+    for path, subdirs, files in os.walk(CRAWL_INPUT):
+        for fn in files:
+            # Remember, file name is also the youtube key in the crawl output
+            # (plus an extension if the file is compressed)
+            ytid, encoding = split_name(fn)
+            with open(os.path.join(path, fn), "rb") as fh:
+                yield ytid, fh.read(), encoding
+
+    for ytid, data, encoding in SegmentReader(CRAWL_SEGMENTS).scan_raw():
+        yield ytid, data, encoding
+
+
+def crawled_files():
+    """Yield (YouTube ID, contents) for every crawled response, decompressed."""
+    for ytid, data, encoding in crawled_records():
+        yield ytid, decompress(data, encoding).decode('utf-8').strip()
+
+
+def crawl_sources():
+    """Yield (path, priority) for every file holding crawled responses.
+
+    Per-video files have priority 0 and segment n has priority n + 1, so
+    when sources disagree about a video the higher priority is newer.
+    """
+    for path, subdirs, files in os.walk(CRAWL_INPUT):
+        for fn in files:
+            yield os.path.join(path, fn), 0
+    for n in list_segments(CRAWL_SEGMENTS):
+        yield os.path.join(CRAWL_SEGMENTS, segment_name(n)), n + 1
+
+
+def source_locations(path, priority):
+    """Yield (YouTube ID, path, offset, length, encoding) for each record in a crawl source.
+
+    A length of None is the whole file.
+    """
+    if priority == 0:
+        ytid, encoding = split_name(os.path.basename(path))
+        yield ytid, path, 0, None, encoding
+    else:
+        for ytid, offset, length, encoding in SegmentReader(CRAWL_SEGMENTS).locate_segment(priority - 1):
+            yield ytid, path, offset, length, encoding
+
+
+def crawled_locations():
+    """Yield source_locations for every crawled response, in crawled_records order."""
+    for path, priority in crawl_sources():
+        for loc in source_locations(path, priority):
+            yield loc
+
+
+# The segment process_record last mapped, as {path: mmap}: a segment's
+# records are parsed one after another, so it is kept until the next one
+SEGMENT_MAP = {}
+
+
+def map_file(path):
+    """Return a read-only mmap of the whole file, or b"" if it is empty."""
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b""  # empty files can't be mapped
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def map_segment(path):
+    """Return an mmap of the segment, unmapping the last one if it differs."""
+    mm = SEGMENT_MAP.get(path)
+    if mm is None:
+        release_segment()
+        mm = SEGMENT_MAP[path] = map_file(path)
+    return mm
+
+
+def release_segment():
+    """Unmap the segment kept by map_segment, if any."""
+    for mm in SEGMENT_MAP.values():
+        if isinstance(mm, mmap.mmap):
+            mm.close()
+    SEGMENT_MAP.clear()
+
+
+def process_record(rec):
+    """Process one tagged record from crawled_locations.
+
+    This is the unit of work for the worker processes. The tag (e.g. a
+    sequence number) is passed back untouched. Plain responses are
+    memory-mapped and searched in place, so only the graph data and brag
+    bar are copied and decoded; compressed ones are decompressed first.
+    Return is a tuple (tag, ytid, daily_stats, brag_bar).
+    """
+    tag, ytid, path, offset, length, encoding = rec
+    if encoding != 'identity':
+        with open(path, "rb") as fh:
+            fh.seek(offset)
+            data = fh.read(-1 if length is None else length)
+        daily_stats, brag_bar = process_crawled(decompress(data, encoding))
+    elif length is None:
+        mm = map_file(path)
+        try:
+            daily_stats, brag_bar = process_crawled(mm)
+        finally:
+            if isinstance(mm, mmap.mmap):
+                mm.close()
+    else:
+        daily_stats, brag_bar = process_crawled(map_segment(path), offset, offset + length)
+    return tag, ytid, daily_stats, brag_bar
+
+
+def crawled_results(workers=1, chunk_size=64):
+    """Yield process_record results for every crawled response.
+
+    The tag of each result is its sequence number: with more than one
+    worker results come back in completion order, so use it to decide
+    which of two records for the same video is newer.
+    """
+    numbered = ((seq, ) + loc for seq, loc in enumerate(crawled_locations()))
+    return parse_records(numbered, workers, chunk_size)
+
+
+def parse_records(tagged, workers=1, chunk_size=64):
+    """Yield process_record results for (tag, ytid, path, offset, length, encoding) records.
+
+    With more than one worker the records are parsed in a process pool and
+    come back in completion order; only their locations are sent to the
+    workers, which read the responses themselves. Only a bounded number of
+    records is queued ahead of the workers.
+    """
+    if workers <= 1:
+        try:
+            for rec in tagged:
+                yield process_record(rec)
+        finally:
+            release_segment()
+        return
+
+    # The pool reads its input from a thread as fast as it can: hold it to
+    # a few chunks per worker so the crawl output is not all scanned up front
+    slots = threading.BoundedSemaphore(workers * chunk_size * 4)
+
+    def throttled():
+        for rec in tagged:
+            slots.acquire()
+            yield rec
+
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(process_record, throttled(), chunk_size):
+            slots.release()
+            yield result
+
+
+class ParseCache(object):
+    """Parsed crawl and API records kept between runs in SQLite.
+
+    A manifest records the size and mtime of every crawl source (per-video
+    file or segment) as of its last parse, and api.json is tracked by how
+    far it has been read. Only new or changed sources and newly appended
+    API lines are parsed; sources that disappeared lose their records.
+
+    Every record parsed from a source is kept, keyed on (ytid, source), and
+    the newest one (highest source priority, then latest in the source)
+    wins when the output is built. All changes from a run are committed
+    together by `commit`, so an interrupted run is simply redone.
+
+    The connection is shared with the thread that feeds the worker pool,
+    so every access holds the lock.
+    """
+
+    def __init__(self, path):
+        """init.
+
+        Arguments:
+        - `path`: the SQLite database file
+        """
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS crawl (ytid TEXT, source TEXT, priority INTEGER, seq INTEGER,'
+            ' daily_stats TEXT, brag_bar TEXT, PRIMARY KEY (ytid, source)) WITHOUT ROWID')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS crawl_source ON crawl (source)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS api (ytid TEXT PRIMARY KEY, stats TEXT, snippet TEXT) WITHOUT ROWID')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS api_read (path TEXT PRIMARY KEY, offset INTEGER, tail BLOB)')
+        self._conn.execute('CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)')
+        self._conn.commit()
+
+    def source_changed(self, path):
+        """Return True if the crawl source must be parsed (again).
+
+        A changed source loses its old records and the manifest is updated
+        as if the new ones were already stored.
+        """
+        st = os.stat(path)
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO seen (path) VALUES (?)', (path, ))
+            row = self._conn.execute('SELECT size, mtime FROM sources WHERE path = ?', (path, )).fetchone()
+            if row == (st.st_size, st.st_mtime):
+                return False
+            self._conn.execute('DELETE FROM crawl WHERE source = ?', (path, ))
+            self._conn.execute('INSERT OR REPLACE INTO sources (path, size, mtime) VALUES (?, ?, ?)',
+                               (path, st.st_size, st.st_mtime))
+            return True
+
+    def forget_unseen(self):
+        """Drop the sources (and their records) not checked by source_changed this run.
+
+        Return is the number of sources dropped.
+        """
+        with self._lock:
+            gone = [r[0] for r in self._conn.execute('SELECT path FROM sources WHERE path NOT IN (SELECT path FROM seen)')]
+            for path in gone:
+                self._conn.execute('DELETE FROM crawl WHERE source = ?', (path, ))
+                self._conn.execute('DELETE FROM sources WHERE path = ?', (path, ))
+            return len(gone)
+
+    def add_crawl(self, source, priority, seq, ytid, daily_stats, brag_bar):
+        """Store the parsed result of one crawled record."""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO crawl (ytid, source, priority, seq, daily_stats, brag_bar)'
+                ' SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS'
+                ' (SELECT 1 FROM crawl WHERE ytid = ? AND source = ? AND seq > ?)',
+                (ytid, source, priority, seq, json.dumps(daily_stats), json.dumps(brag_bar), ytid, source, seq))
+
+    def update_api(self, path):
+        """Parse the lines appended to the API output since the last run.
+
+        If the file no longer holds what was read before (it was replaced
+        or rewritten) it is read again from the start.
+
+        Return is a tuple (lines read, records stored).
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT offset, tail FROM api_read WHERE path = ?', (path, )).fetchone()
+        offset, tail = row if row else (0, b'')
+        count, processed = 0, 0
+        if not os.path.exists(path):
+            return count, processed
+
+        with open(path, 'rb') as fh:
+            if offset > os.path.getsize(path):
+                offset = 0
+            else:
+                fh.seek(offset - len(tail))
+                if fh.read(len(tail)) != tail:
+                    offset = 0
+            with self._lock:
+                if offset == 0:
+                    self._conn.execute('DELETE FROM api')
+                fh.seek(offset)
+                for line in fh:
+                    if not line.endswith(b'\n'):
+                        break  # a line still being written
+                    offset += len(line)
+                    tail = line[-64:]
+                    line = line.strip()
+                    if not line:
+                        continue
+                    count += 1
+                    rec = json.loads(line.decode('utf-8'))
+                    ytid = rec.get("id", "").strip()
+                    if not ytid:
+                        continue
+                    processed += 1
+                    self._conn.execute('INSERT OR REPLACE INTO api (ytid, stats, snippet) VALUES (?, ?, ?)', (
+                        ytid, json.dumps(rec.get("statistics", {})), json.dumps(rec.get("snippet", {}))))
+                self._conn.execute('INSERT OR REPLACE INTO api_read (path, offset, tail) VALUES (?, ?, ?)', (path, offset, tail))
+        return count, processed
+
+    def records(self):
+        """Return (YouTube ID, data) pairs for every video in the cache, ordered by ID.
+
+        The data dict has the same keys ("daily_stats", "brag_bar", "stats",
+        "snippet") that main builds from a full pass.
+        """
+        crawl = self._conn.cursor().execute(
+            'SELECT ytid, daily_stats, brag_bar FROM crawl ORDER BY ytid, priority, seq')
+        api = self._conn.cursor().execute('SELECT ytid, stats, snippet FROM api ORDER BY ytid')
+
+        def newest(rows):
+            # the last row for each ID is the newest
+            prev = None
+            for row in rows:
+                if prev is not None and prev[0] != row[0]:
+                    yield prev
+                prev = row
+            if prev is not None:
+                yield prev
+
+        return merge_by_id(
+            ((ytid, {"daily_stats": json.loads(ds), "brag_bar": json.loads(bb)}) for ytid, ds, bb in newest(crawl)),
+            ((ytid, {"stats": json.loads(st), "snippet": json.loads(sn)}) for ytid, st, sn in api))
+
+    def commit(self):
+        """Commit everything stored this run."""
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        """Close the database, discarding anything not committed."""
+        with self._lock:
+            self._conn.close()
+
+
+def progress(records, every=10.0):
+    """Yield from records, logging how many and how fast every `every` seconds."""
+    start = last_report = time.time()
+    for count, rec in enumerate(records, 1):
+        now = time.time()
+        if now - last_report >= every:
+            log("Processing crawled data: %12d records, %.1f/s", count, count / (now - start))
+            last_report = now
+        yield rec
+
+
+def combine_full(args):
+    """Parse all crawled data and API output into memory.
+
+    Return is a dict of data dicts keyed on YouTube ID.
+    """
     # We store everything as a dict keyed on YouTube ID
     all_data = collections.defaultdict(dict)
 
     # Process crawled data
-    log("Processing crawled data")
+    log("Processing crawled data with %d worker(s)", args.workers)
     count, processed = 0, 0
-    for path, subdirs, files in os.walk(CRAWL_INPUT):
-        for fn in files:
-            count += 1
-            # Remember, file name is also the youtube key in the crawl output
-            with open(os.path.join(path, fn), "r") as fh:
-                data = fh.read().strip()
-            log("Processing crawled data: [%s] len=%12d", fn, len(data))
-            daily_stats, brag_bar = process_crawled(data)
-            if not daily_stats and not brag_bar:
-                continue  # Nothing to do
+    start = time.time()
+    for seq, ytid, daily_stats, brag_bar in progress(crawled_results(args.workers, args.chunk_size)):
+        count += 1
+        if not daily_stats and not brag_bar:
+            continue  # Nothing to do
 
-            processed += 1
-            all_data[fn]["daily_stats"] = daily_stats
-            all_data[fn]["brag_bar"] = brag_bar
+        processed += 1
+        rec = all_data[ytid]
+        if rec.get("crawl_seq", -1) > seq:
+            continue  # A newer record for this video was already merged
+        rec["crawl_seq"] = seq
+        rec["daily_stats"] = daily_stats
+        rec["brag_bar"] = brag_bar
+        ALL_BRAG_BAR.update(brag_bar)
 
-    log("Processed crawled data: %d out of %d", processed, count)
+    elapsed = max(time.time() - start, 1e-6)
+    log("Processed crawled data: %d out of %d (%.1f/s)", processed, count, count / elapsed)
     log("All brag bar labels: %s", repr(ALL_BRAG_BAR))
 
     # Process API content
@@ -161,55 +631,411 @@ def main():
         all_data[ytid]["snippet"] = rec.get("snippet", {})
 
     log("Processed API data: %d out of %d", processed, count)
+    return all_data
+
+
+def combine_incremental(args, cache):
+    """Bring the parse cache up to date with the crawled data and API output."""
+    log("Checking crawled data against the cache")
+    changed = [0]
+
+    def tagged():
+        for path, priority in crawl_sources():
+            if not cache.source_changed(path):
+                continue
+            changed[0] += 1
+            for seq, loc in enumerate(source_locations(path, priority)):
+                yield ((path, priority, seq), ) + loc
+
+    count, processed = 0, 0
+    for (path, priority, seq), ytid, daily_stats, brag_bar in progress(parse_records(tagged(), args.workers, args.chunk_size)):
+        count += 1
+        if not daily_stats and not brag_bar:
+            continue  # Nothing to do
+
+        processed += 1
+        cache.add_crawl(path, priority, seq, ytid, daily_stats, brag_bar)
+
+    log("Processed crawled data: %d out of %d from %d new or changed sources", processed, count, changed[0])
+    log("Dropped %d crawl sources that no longer exist", cache.forget_unseen())
+
+    log("Processing JSON retrieve from API")
+    count, processed = cache.update_api(API_FILE)
+    log("Processed API data: %d out of %d new lines", processed, count)
+
+    cache.commit()
+
+
+def newest_by_id(lines):
+    """Yield (YouTube ID, payload) from sorted "ytid\\tseq\\tpayload" lines.
+
+    Of the lines for one ID only the last (highest seq) is kept.
+    """
+    prev = None
+    for line in lines:
+        ytid, seq, payload = line.split("\t", 2)
+        if prev is not None and prev[0] != ytid:
+            yield prev
+        prev = (ytid, payload)
+    if prev is not None:
+        yield prev
+
+
+def merge_by_id(crawl, api):
+    """Merge-join (ytid, data) streams ordered by ID into (ytid, data) pairs."""
+    c, a = next(crawl, None), next(api, None)
+    while c is not None or a is not None:
+        if a is None or (c is not None and c[0] <= a[0]):
+            ytid = c[0]
+        else:
+            ytid = a[0]
+        data = {}
+        if c is not None and c[0] == ytid:
+            data.update(c[1])
+            c = next(crawl, None)
+        if a is not None and a[0] == ytid:
+            data.update(a[1])
+            a = next(api, None)
+        yield ytid, data
+
+
+def combine_streaming(args):
+    """Parse all crawled data and API output into ID-sorted runs on disk.
+
+    Return is a generator of (YouTube ID, data dict) in ID order, built by
+    merging the runs, so memory stays near `args.memory_mb` however large
+    the corpus is.
+    """
+    budget = args.memory_mb * 1024 * 1024
+    tmp_dir = tempfile.mkdtemp(prefix="combine-", dir=args.tmp_dir)
+
+    # Fixed width sequence numbers so that plain string order is (ytid, seq)
+    log("Processing crawled data with %d worker(s) into sorted runs", args.workers)
+    crawl_sort = ExternalSort(tmp_dir, budget)
+    count, processed = 0, 0
+    for seq, ytid, daily_stats, brag_bar in progress(crawled_results(args.workers, args.chunk_size)):
+        count += 1
+        if not daily_stats and not brag_bar:
+            continue  # Nothing to do
+
+        processed += 1
+        payload = json.dumps({"daily_stats": daily_stats, "brag_bar": brag_bar})
+        crawl_sort.add("%s\t%012d\t%s" % (ytid, seq, payload))
+    log("Processed crawled data: %d out of %d", processed, count)
+
+    log("Processing JSON retrieve from API into sorted runs")
+    api_sort = ExternalSort(tmp_dir, budget)
+    count, processed = 0, 0
+    for line in lines(API_FILE):
+        count += 1
+        rec = json.loads(line)
+        ytid = rec.get("id", "").strip()
+        if not ytid:
+            continue
+
+        processed += 1
+        payload = json.dumps({"stats": rec.get("statistics", {}), "snippet": rec.get("snippet", {})})
+        api_sort.add("%s\t%012d\t%s" % (ytid, count, payload))
+    log("Processed API data: %d out of %d", processed, count)
+
+    def records():
+        try:
+            crawl = ((ytid, json.loads(p)) for ytid, p in newest_by_id(crawl_sort.sorted_lines()))
+            api = ((ytid, json.loads(p)) for ytid, p in newest_by_id(api_sort.sorted_lines()))
+            for rec in merge_by_id(crawl, api):
+                yield rec
+        finally:
+            shutil.rmtree(tmp_dir, True)
+
+    return records()
+
+
+class CSVOutput(object):
+    """Write rows to a CSV file with a header line."""
+
+    def __init__(self, path, cols):
+        """init.
+
+        Arguments:
+        - `path`: the file to write
+        - `cols`: the column names
+        """
+        self._fh = open(path, "w", buffering=1 << 20)
+        self._csv = csv.writer(self._fh, quoting=csv.QUOTE_NONNUMERIC)
+        self._csv.writerow(cols)
+
+    def writerow(self, row):
+        """Write one row."""
+        self._csv.writerow(row)
+
+    def writerows(self, rows):
+        """Write a list of rows."""
+        self._csv.writerows(rows)
+
+    def flush(self):
+        """Flush the rows written so far to the file."""
+        self._fh.flush()
+
+    def close(self):
+        """Close the file."""
+        self._fh.close()
+
+
+class TableOutput(object):
+    """Write rows to a Parquet file or an Arrow IPC stream, a row group at a time.
+
+    Columns are typed from COLUMN_TYPES, with empty numbers stored as nulls
+    and days as dates. Columns named in `dictionary_cols` are dictionary
+    encoded. pyarrow is only needed when this output is used.
+    """
+
+    def __init__(self, path, cols, fmt, dictionary_cols=(), rows_per_group=500000):
+        """init.
+
+        Arguments:
+        - `path`: the file to write
+        - `cols`: the column names
+        - `fmt`: "parquet" or "arrow"
+        - `dictionary_cols`: the columns to dictionary encode
+        - `rows_per_group`: rows buffered before a row group is written
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("%s output needs the pyarrow package" % fmt)
+        self._pa = pyarrow
+
+        types = {"int64": pyarrow.int64(), "date": pyarrow.date32()}
+        fields = []
+        for col in cols:
+            typ = types.get(COLUMN_TYPES.get(col), pyarrow.string())
+            if col in dictionary_cols:
+                typ = pyarrow.dictionary(pyarrow.int32(), typ)
+            fields.append(pyarrow.field(col, typ))
+        self._schema = pyarrow.schema(fields)
+
+        self._rows_per_group = rows_per_group
+        self._dates = {}
+        self._columns = [[] for col in cols]
+        self._types = [COLUMN_TYPES.get(col) for col in cols]
+        if fmt == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        else:
+            self._writer = pyarrow.ipc.new_stream(path, self._schema)
+
+    def writerow(self, row):
+        """Buffer one row, writing a row group when enough are buffered."""
+        for column, typ, value in zip(self._columns, self._types, row):
+            if typ and value == "":
+                value = None
+            elif typ == "date":
+                date = self._dates.get(value)
+                if date is None:
+                    date = self._dates[value] = datetime.date.fromisoformat(value)
+                value = date
+            column.append(value)
+        if len(self._columns[0]) >= self._rows_per_group:
+            self._flush()
+
+    def writerows(self, rows):
+        """Buffer a list of rows."""
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        """Write the buffered rows as a (possibly short) row group."""
+        self._flush()
+
+    def _flush(self):
+        if not self._columns[0]:
+            return
+        arrays = []
+        for column, field in zip(self._columns, self._schema):
+            if self._pa.types.is_dictionary(field.type):
+                arrays.append(self._pa.array(column, field.type.value_type).dictionary_encode())
+            else:
+                arrays.append(self._pa.array(column, field.type))
+        self._writer.write_batch(self._pa.record_batch(arrays, schema=self._schema))
+        self._columns = [[] for column in self._columns]
+
+    def close(self):
+        """Write any buffered rows and close the file."""
+        self._flush()
+        self._writer.close()
+
+
+def output_path(path, fmt):
+    """Return the output file name for the format."""
+    return os.path.splitext(path)[0] + OUTPUT_EXTENSIONS[fmt]
+
+
+def open_output(path, cols, fmt, dictionary_cols=()):
+    """Return a CSVOutput or TableOutput for the format."""
+    if fmt == "csv":
+        return CSVOutput(path, cols)
+    return TableOutput(path, cols, fmt, dictionary_cols)
+
+
+class Outputs(object):
+    """The data and daily output files, written a video at a time."""
+
+    def __init__(self, fmt="csv"):
+        """init.
+
+        Arguments:
+        - `fmt`: "csv", "parquet" or "arrow"
+        """
+        self.data_path = output_path(OUTPUT_DATA, fmt)
+        self.daily_path = output_path(OUTPUT_DAILIES, fmt)
+        log("Writing output file:     %s", self.data_path)
+        log("Writing daily data file: %s", self.daily_path)
+        self.data_count, self.daily_count = 0, 0
+        self._data_out = open_output(self.data_path, DATA_COLS, fmt)
+        self._daily_out = open_output(self.daily_path, DAILY_COLS, fmt, dictionary_cols=("YouTubeID", ))
+
+    def write(self, ytid, data):
+        """Write the rows for one video from its data dict."""
+        # From API
+        stats = data.get("stats", {})
+        snippet = data.get("snippet", {})
+        # From crawl
+        daily_stats = data.get("daily_stats", {})
+        brag_bar = data.get("brag_bar", {})
+        ALL_BRAG_BAR.update(brag_bar)
+
+        # Write out the main data record
+        self.data_count += 1
+        self._data_out.writerow([
+            ytid,                                            # YouTubeID
+            "https://youtube.com/watch?v="+ytid,             # WatchURL
+            normws(snippet.get("title", "")),                # Title
+            snippet.get("channelTitle", ""),                 # Channel
+            ints(stats.get("commentCount", "")),             # StatsCommentCount
+            ints(stats.get("dislikeCount", "")),             # StatsDislikeCount
+            ints(stats.get("favoriteCount", "")),            # StatsFavoriteCount
+            ints(stats.get("likeCount", "")),                # StatsLikeCount
+            ints(stats.get("viewCount", "")),                # StatsViewCount
+            ints(brag_bar.get("Shares", "")),                # BBShares
+            ints(brag_bar.get("Subscriptions driven", "")),  # BBSubscriptions
+            ints(brag_bar.get("Views", "")),                 # BBViews
+            brag_bar.get("Time watched", ""),                # BBTimeWatched
+            normws(snippet.get("description", "")),          # Description
+            "|".join(snippet.get("tags", [])),               # Tags
+        ])
+
+        # Write out all the daily views
+        days = daily_stats.get("day", {}).get("data", [])
+        views = daily_stats.get("views", {}).get("daily", {}).get("data", [])
+        rows = [[ytid, day, v] for day, v in zip(ts_to_days(days), views)]
+        self._daily_out.writerows(rows)
+        self.daily_count += len(rows)
+
+    def flush(self):
+        """Push the rows written so far to the files."""
+        self._data_out.flush()
+        self._daily_out.flush()
+
+    def close(self):
+        """Close both files."""
+        self._data_out.close()
+        self._daily_out.close()
+        log("Wrote %12d to %s", self.data_count, self.data_path)
+        log("Wrote %12d to %s", self.daily_count, self.daily_path)
+
+
+def write_outputs(records, fmt="csv"):
+    """Write the data and daily files from (YouTube ID, data dict) pairs.
+
+    Arguments:
+    - `records`: the (YouTube ID, data dict) pairs
+    - `fmt`: "csv", "parquet" or "arrow"
+    """
+    outputs = Outputs(fmt)
+    try:
+        for ytid, data in records:
+            outputs.write(ytid, data)
+    finally:
+        outputs.close()
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers",
+        help="processes parsing the crawled data (default 1, no pool)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="crawled records sent to a worker at a time",
+        type=int,
+        default=64
+    )
+    parser.add_argument(
+        "--verify-bragbar",
+        help="only check the fast brag bar parser against BeautifulSoup",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only parse new or changed inputs, keeping results in --cache",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--cache",
+        help="the parse cache used by --incremental",
+        default=CACHE_FILE
+    )
+    parser.add_argument(
+        "--format",
+        help="output file format; parquet and arrow need pyarrow (default csv)",
+        choices=sorted(OUTPUT_EXTENSIONS),
+        default="csv"
+    )
+    parser.add_argument(
+        "--streaming",
+        help="sort parsed data on disk instead of holding it all in memory",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--memory-mb",
+        help="memory for sorting with --streaming (default 256)",
+        type=int,
+        default=256
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        help="where --streaming keeps its sorted runs (default system temp)",
+        default=None
+    )
+    args = parser.parse_args()
+    if args.streaming and args.incremental:
+        parser.error("--streaming and --incremental cannot be combined")
+
+    if args.verify_bragbar:
+        if verify_bragbar():
+            raise SystemExit(1)
+        return
+
+    if args.streaming:
+        write_outputs(combine_streaming(args), args.format)
+        log("All brag bar labels: %s", repr(ALL_BRAG_BAR))
+        return
+
+    if not args.incremental:
+        write_outputs(combine_full(args).items(), args.format)
+        return
 
-    # Output final CSV files
-    log("Writing output file:     %s", OUTPUT_DATA)
-    log("Writing daily data file: %s", OUTPUT_DAILIES)
-    data_count, daily_count = 0, 0
-    with open(OUTPUT_DATA, "w") as data_fh, open(OUTPUT_DAILIES, "w") as daily_fh:
-        data_csv = csv.writer(data_fh, quoting=csv.QUOTE_NONNUMERIC)
-        data_csv.writerow(DATA_COLS)
-
-        daily_csv = csv.writer(daily_fh, quoting=csv.QUOTE_NONNUMERIC)
-        daily_csv.writerow(DAILY_COLS)
-
-        for ytid, data in all_data.items():
-            # From API
-            stats = data.get("stats", {})
-            snippet = data.get("snippet", {})
-            # From crawl
-            daily_stats = data.get("daily_stats", {})
-            brag_bar = data.get("brag_bar", {})
-
-            # Write out the main data record
-            data_count += 1
-            data_csv.writerow([
-                ytid,                                            # YouTubeID
-                "https://youtube.com/watch?v="+ytid,             # WatchURL
-                normws(snippet.get("title", "")),                # Title
-                snippet.get("channelTitle", ""),                 # Channel
-                ints(stats.get("commentCount", "")),             # StatsCommentCount
-                ints(stats.get("dislikeCount", "")),             # StatsDislikeCount
-                ints(stats.get("favoriteCount", "")),            # StatsFavoriteCount
-                ints(stats.get("likeCount", "")),                # StatsLikeCount
-                ints(stats.get("viewCount", "")),                # StatsViewCount
-                ints(brag_bar.get("Shares", "")),                # BBShares
-                ints(brag_bar.get("Subscriptions driven", "")),  # BBSubscriptions
-                ints(brag_bar.get("Views", "")),                 # BBViews
-                brag_bar.get("Time watched", ""),                # BBTimeWatched
-                normws(snippet.get("description", "")),          # Description
-                "|".join(snippet.get("tags", [])),               # Tags
-            ])
-
-            # Write out all the daily views
-            days = daily_stats.get("day", {}).get("data", [])
-            views = daily_stats.get("views", {}).get("daily", {}).get("data", [])
-            for d, v in zip(days, views):
-                daily_csv.writerow([ytid, ts_to_day(d), v])
-                daily_count += 1
-
-    log("Wrote %12d to %s", data_count, OUTPUT_DATA)
-    log("Wrote %12d to %s", daily_count, OUTPUT_DAILIES)
+    cache = ParseCache(args.cache)
+    try:
+        combine_incremental(args, cache)
+        write_outputs(cache.records(), args.format)
+        log("All brag bar labels: %s", repr(ALL_BRAG_BAR))
+    finally:
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -4,10 +4,15 @@
 
 import argparse
 import csv
+import hashlib
+import heapq
 import inspect
+import math
 import os
 import re
+import shutil
 import sys
+import tempfile
 
 import os.path as pth
 
@@ -53,6 +58,130 @@ def fields(filename):
                     yield fld
 
 
+class ExternalSort(object):
+    """Sort text lines under a memory budget using sorted runs on disk.
+
+    Lines are collected until their size passes the budget, then sorted
+    and written to a run file. `sorted_lines` merges the runs, first in
+    passes of at most `fan_in` files if there are many of them. Lines must
+    not contain newlines. With `unique` repeats are dropped from each run
+    (but not across runs).
+    """
+
+    def __init__(self, tmp_dir, memory_bytes, fan_in=64, unique=False):
+        """init.
+
+        Arguments:
+        - `tmp_dir`: the directory for run files
+        - `memory_bytes`: roughly the most memory held by unsorted lines
+        - `fan_in`: the most runs merged at once
+        - `unique`: drop repeated lines within each run
+        """
+        self._tmp_dir = tmp_dir
+        self._memory_bytes = memory_bytes
+        self._fan_in = fan_in
+        self._unique = unique
+        self._lines = []
+        self._size = 0
+        self._runs = []
+
+    def add(self, line):
+        """Add one line."""
+        self._lines.append(line)
+        # a str costs about 50 bytes over its text, plus the list slot
+        self._size += len(line) + 58
+        if self._size >= self._memory_bytes:
+            self._spill()
+
+    def _sort(self):
+        if self._unique:
+            self._lines = list(set(self._lines))
+        self._lines.sort()
+
+    def _spill(self):
+        self._sort()
+        self._runs.append(self._write_run(self._lines))
+        self._lines = []
+        self._size = 0
+
+    def _write_run(self, lines):
+        fd, path = tempfile.mkstemp(suffix=".run", dir=self._tmp_dir)
+        with os.fdopen(fd, "w") as fh:
+            for line in lines:
+                fh.write(line)
+                fh.write("\n")
+        return path
+
+    @staticmethod
+    def _read_run(path):
+        with open(path) as fh:
+            for line in fh:
+                yield line[:-1]
+
+    def _merge(self, paths):
+        return heapq.merge(*[self._read_run(p) for p in paths])
+
+    def sorted_lines(self):
+        """Yield every line added, in sorted order, removing the run files."""
+        if not self._runs:
+            self._sort()
+            lines, self._lines = self._lines, []
+            for line in lines:
+                yield line
+            return
+
+        if self._lines:
+            self._spill()
+        runs = self._runs
+        try:
+            while len(runs) > self._fan_in:
+                group, runs = runs[:self._fan_in], runs[self._fan_in:]
+                runs.append(self._write_run(self._merge(group)))
+                for path in group:
+                    os.remove(path)
+            for line in self._merge(runs):
+                yield line
+        finally:
+            for path in runs:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._runs = []
+
+
+class BloomFilter(object):
+    """A fixed-size set that can answer "maybe seen" for keys never added.
+
+    Sized for `capacity` keys at a false positive rate of `error_rate`; it
+    uses about 1.8 bytes per key at 0.1%. Past its capacity the false
+    positive rate climbs.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """init.
+
+        Arguments:
+        - `capacity`: the number of keys expected
+        - `error_rate`: the chance a key not added is reported as seen
+        """
+        self._bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self._hashes = max(1, int(round(self._bits / capacity * math.log(2))))
+        self._array = bytearray((self._bits + 7) // 8)
+
+    def add(self, key):
+        """Add a key; return True if it may have been added before."""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        seen = True
+        for i in range(self._hashes):
+            bit = (h1 + i * h2) % self._bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self._array[byte] & mask:
+                seen = False
+                self._array[byte] |= mask
+        return seen
+
+
 def check_env_file():
     """Check for existence of env file and process it."""
     if pth.isfile(".env"):
@@ -68,11 +197,8 @@ def check_env_file():
                 os.environ[key] = val
 
 
-def youtube_id_from_cmdline():
-    """Parse the command line and then parse the indicated file for YT id's.
-
-    Assumes a CLI script, so if an error is found the process is exited.
-    """
+def cmdline_parser():
+    """Return an argument parser with the YouTube ID input options."""
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-f", "--input",
@@ -84,8 +210,40 @@ def youtube_id_from_cmdline():
         help="CSV input file with YouTube URL's like .../watch?v=youtube-id",
         required=False
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--external-dedup",
+        help="stream the ID's, removing duplicates with a sort on disk",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--dedup-memory-mb",
+        help="memory for --external-dedup (default 256)",
+        type=int,
+        default=256
+    )
+    parser.add_argument(
+        "--bloom",
+        help="with --external-dedup, spot possible repeats early with a Bloom "
+             "filter sized for this many ID's (about 1.8 bytes each)",
+        type=int,
+        default=0
+    )
+    return parser
 
+
+def youtube_id_from_cmdline(parser=None):
+    """Parse the command line and then parse the indicated file for YT id's.
+
+    Assumes a CLI script, so if an error is found the process is exited. A
+    parser from `cmdline_parser` with extra options may be passed in; use
+    `youtube_id_from_args` instead if you need the parsed options.
+    """
+    parser = parser or cmdline_parser()
+    return youtube_id_from_args(parser, parser.parse_args())
+
+
+def youtube_id_from_args(parser, args):
+    """Parse the file indicated by already parsed command line args for YT id's."""
     def cmderror(msg):
         log(msg)
         parser.print_help()
@@ -96,22 +254,76 @@ def youtube_id_from_cmdline():
     if args.input and args.csv:
         cmderror("You may only specify one of --input and --csv")
 
-    yt_ids = set()
+    if getattr(args, "external_dedup", False):
+        return unique_ids(raw_youtube_ids(args), args.dedup_memory_mb, args.bloom)
+
+    yt_ids = set(raw_youtube_ids(args))
+
+    if not yt_ids:
+        log("Could not find any YouTube ID's")
+        sys.exit(2)
 
+    log("Found %d YoutTube ID's", len(yt_ids))
+
+    return yt_ids
+
+
+def raw_youtube_ids(args):
+    """Yield every YouTube ID in the input indicated by the args, repeats included."""
     if args.input:
         for line in lines(args.input):
-            yt_ids.add(line)
+            yield line
     elif args.csv:
         ytid_re = re.compile(r'v=([A-Za-z0-9\-_]+)')
         for fld in fields(args.csv):
             match = ytid_re.findall(fld)
             if match and match[0]:
-                yt_ids.add(match[0])
+                yield match[0]
 
-    if not yt_ids:
+
+def unique_ids(ids, memory_mb=256, bloom=0, tmp_dir=None):
+    """Yield the distinct ID's from an iterable in sorted order.
+
+    ID's are sorted on disk with an ExternalSort, so memory stays near
+    `memory_mb` however many there are. With a Bloom filter sized for
+    `bloom` ID's, those it has certainly not seen before go straight to the
+    sort; the possible repeats go to a second sort that drops repeats as
+    it goes, so heavily repeated input spills much less to disk. The two
+    are merged and every repeat is removed exactly. Exits the process if
+    there are no ID's, like youtube_id_from_args.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="ytids-", dir=tmp_dir)
+    try:
+        memory_bytes = memory_mb * 1024 * 1024
+        prefilter, repeats, maybe_seen = None, None, 0
+        if bloom:
+            prefilter = BloomFilter(bloom)
+            memory_bytes //= 2
+            repeats = ExternalSort(tmp_dir, memory_bytes, unique=True)
+        sorter = ExternalSort(tmp_dir, memory_bytes)
+        for ytid in ids:
+            if prefilter is not None and prefilter.add(ytid):
+                maybe_seen += 1
+                repeats.add(ytid)
+            else:
+                sorter.add(ytid)
+
+        merged = sorter.sorted_lines()
+        if repeats is not None:
+            merged = heapq.merge(merged, repeats.sorted_lines())
+        count, prev = 0, None
+        for ytid in merged:
+            if ytid != prev:
+                count += 1
+                yield ytid
+            prev = ytid
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    if not count:
         log("Could not find any YouTube ID's")
         sys.exit(2)
 
-    log("Found %d YoutTube ID's", len(yt_ids))
-
-    return yt_ids
+    if prefilter is not None:
+        log("Bloom filter passed %d ID's as possible repeats", maybe_seen)
+    log("Found %d YoutTube ID's", count)
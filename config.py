@@ -0,0 +1,62 @@
+"""Paths and settings shared by the scripts in this directory.
+
+Importing this is cheap and has no side effects: the .env file and the
+environment are only read when the API key is first asked for, so scripts
+that never call the API (like combine.py) run without YT_KEY.
+"""
+
+# pylama:ignore=E501,D213
+
+import os
+
+from common import check_env_file, rel_path
+
+# do_crawl.py: the ID's for the current crawl, and where responses are stored
+BATCH_FILE = rel_path("batch_ytid.txt")
+OUTPUT_DIR = rel_path("output")
+CRAWL_INPUT = os.path.join(OUTPUT_DIR, "data")
+CRAWL_SEGMENTS = os.path.join(OUTPUT_DIR, "segments")
+
+# do_api.py: one JSON record per line
+API_FILE = rel_path("api.json")
+
+# combine.py: the files written, and the parse cache used by --incremental
+OUTPUT_DATA = rel_path("youtube-data.csv")
+OUTPUT_DAILIES = rel_path("youtube-daily-views.csv")
+CACHE_FILE = rel_path("combine.cache.db")
+
+# The columns of youtube-data.csv in order, each with the API field ("part/
+# field") it comes from or None. do_api.py requests only these fields, so a
+# column combine.py takes from the API must name its field here.
+DATA_COLUMNS = [
+    ("YouTubeID", None),
+    ("WatchURL", None),
+    ("Title", "snippet/title"),
+    ("Channel", "snippet/channelTitle"),
+    ("StatsCommentCount", "statistics/commentCount"),
+    ("StatsDislikeCount", "statistics/dislikeCount"),
+    ("StatsFavoriteCount", "statistics/favoriteCount"),
+    ("StatsLikeCount", "statistics/likeCount"),
+    ("StatsViewCount", "statistics/viewCount"),
+    # From the crawled brag bar
+    ("BBShares", None),
+    ("BBSubscriptions", None),
+    ("BBViews", None),
+    ("BBTimeWatched", None),
+    ("Description", "snippet/description"),
+    ("Tags", "snippet/tags"),
+]
+
+_api_key = None
+
+
+def api_key():
+    """Return the YouTube API key, reading .env and YT_KEY on first use."""
+    global _api_key
+    if _api_key is None:
+        check_env_file()
+        key = os.environ.get('YT_KEY')
+        if not key:
+            raise ValueError("YT_KEY env variable not set")
+        _api_key = key
+    return _api_key
@@ -12,64 +12,374 @@ The final file will api.json
 
 # pylama:ignore=E501,D213
 
-import requests
+import collections
+import concurrent.futures
+import functools
 import json
 import os
+import random
+import sqlite3
+import threading
+import time
 
-from common import check_env_file, youtube_id_from_cmdline, log, rel_path
-
-check_env_file()
-KEY = os.environ['YT_KEY']
-if not KEY:
-    raise ValueError("YT_KEY env variable not set")
+import config
+from common import cmdline_parser, youtube_id_from_args, log
 
 # Make sure other scripts can import our target file
-OUTPUT_FILE = rel_path("api.json")
+OUTPUT_FILE = config.API_FILE
+
+
+# The API field behind each of the combine.py columns taken from the API;
+# only these are requested unless full records are asked for
+API_FIELDS = collections.OrderedDict(
+    (name, field) for name, field in config.DATA_COLUMNS if field is not None)
+
+
+def projection(columns=None):
+    """Return the (part, fields) request parameters for the given columns.
+
+    Arguments:
+    - `columns`: names from API_FIELDS, default all of them
+    """
+    parts = collections.OrderedDict()
+    for col in (columns or API_FIELDS):
+        if col not in API_FIELDS:
+            raise ValueError("%s is not a column from the API" % col)
+        part, field = API_FIELDS[col].split("/")
+        parts.setdefault(part, []).append(field)
+    fields = ",".join("%s(%s)" % (part, ",".join(names)) for part, names in parts.items())
+    return ",".join(parts), "items(id,%s)" % fields
+
+
+# How long a fetched record is fresh by default
+DEFAULT_TTL_HOURS = 24
+
+# Statuses worth retrying: quota and rate limits, and server errors
+RETRY_STATUSES = {403, 429, 500, 502, 503, 504}
+
+
+class ApiCache(object):
+    """An index of when each video in the API output was last fetched.
+
+    Every record written to the output carries a `_fetched` time (seconds
+    since the epoch). The index is kept in SQLite next to the output and
+    only reads the lines appended since its last refresh; if the output no
+    longer holds what was read before, it is indexed again from the start.
+    Records written before `_fetched` existed count as stale.
+    """
+
+    def __init__(self, path, ttl):
+        """init.
+
+        Arguments:
+        - `path`: the API output (JSON lines)
+        - `ttl`: seconds a fetched record stays fresh
+        """
+        self._path = path
+        self._ttl = ttl
+        self._conn = sqlite3.connect(path + ".db")
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS fetched (ytid TEXT PRIMARY KEY, ts REAL, offset INTEGER) WITHOUT ROWID')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS read (name TEXT PRIMARY KEY, offset INTEGER, tail BLOB)')
+        self._conn.commit()
+
+    def refresh(self):
+        """Index the records appended to the output since the last refresh.
+
+        Return is the number of lines read.
+        """
+        row = self._conn.execute("SELECT offset, tail FROM read WHERE name = 'output'").fetchone()
+        offset, tail = row if row else (0, b'')
+        if not os.path.exists(self._path):
+            return 0
+
+        count = 0
+        with open(self._path, 'rb') as fh:
+            if offset > os.path.getsize(self._path):
+                offset = 0
+            else:
+                fh.seek(offset - len(tail))
+                if fh.read(len(tail)) != tail:
+                    offset = 0
+            if offset == 0:
+                self._conn.execute('DELETE FROM fetched')
+            fh.seek(offset)
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    break  # a line still being written
+                start, offset, tail = offset, offset + len(line), line[-64:]
+                if not line.strip():
+                    continue
+                count += 1
+                rec = json.loads(line.decode('utf-8'))
+                ytid = rec.get("id", "").strip()
+                if ytid:
+                    self._conn.execute('INSERT OR REPLACE INTO fetched (ytid, ts, offset) VALUES (?, ?, ?)',
+                                       (ytid, rec.get("_fetched", 0), start))
+        self._conn.execute("INSERT OR REPLACE INTO read (name, offset, tail) VALUES ('output', ?, ?)", (offset, tail))
+        self._conn.commit()
+        return count
+
+    def is_fresh(self, ytid, now=None):
+        """Return True if the video was fetched within the TTL."""
+        row = self._conn.execute('SELECT ts FROM fetched WHERE ytid = ?', (ytid, )).fetchone()
+        return row is not None and row[0] >= (now or time.time()) - self._ttl
+
+    def get(self, ytid):
+        """Return the latest record for the video, or None."""
+        row = self._conn.execute('SELECT offset FROM fetched WHERE ytid = ?', (ytid, )).fetchone()
+        if row is None:
+            return None
+        with open(self._path, 'rb') as fh:
+            fh.seek(row[0])
+            return json.loads(fh.readline().decode('utf-8'))
+
+    def compact(self):
+        """Rewrite the output keeping only the latest record for each video.
+
+        Return is a tuple (lines before, lines after).
+        """
+        self.refresh()
+        before, after = 0, 0
+        tmp = self._path + ".compact"
+        with open(self._path, 'rb') as src, open(tmp, 'wb') as dst:
+            offset = 0
+            for line in src:
+                start, offset = offset, offset + len(line)
+                if not line.endswith(b'\n') or not line.strip():
+                    continue
+                before += 1
+                ytid = json.loads(line.decode('utf-8')).get("id", "").strip()
+                row = self._conn.execute('SELECT offset FROM fetched WHERE ytid = ?', (ytid, )).fetchone()
+                if row and row[0] == start:
+                    dst.write(line)
+                    after += 1
+        os.replace(tmp, self._path)
+        self._conn.execute('DELETE FROM read')
+        self._conn.commit()
+        self.refresh()
+        return before, after
+
+    def close(self):
+        """Close the index."""
+        self._conn.close()
 
 
 class Getter(object):
-    """Stateful ReST getter for YouTube."""
+    """Stateful ReST getter for YouTube.
+
+    ID's are sent in batches of up to 50 (the most the videos endpoint
+    takes), with up to `workers` batches in flight at once. Each worker
+    thread keeps a requests Session so connections are reused. Results go
+    to one output file kept open for the whole run. Batches that fail with
+    a quota, rate limit or server error are retried with exponential
+    backoff. Each record is stamped with the time it was fetched, and ID's
+    still fresh in the ApiCache (if given) are not fetched again.
 
-    def __init__(self):
-        """Ctor."""
+    Only the fields in `fields` are requested (see `projection`), and
+    responses are asked for gzipped; Google's APIs only compress for user
+    agents that mention gzip.
+    """
+
+    def __init__(self, batch_size=50, workers=4, max_attempts=5, base_delay=1.0, cache=None,
+                 part='statistics,snippet', fields=None, callback=None):
+        """Ctor.
+
+        Arguments:
+        - `batch_size`: ID's per request, at most 50
+        - `workers`: the number of requests in flight at once
+        - `max_attempts`: tries per batch before it is given up
+        - `base_delay`: seconds before the first retry, doubled for each one
+        - `cache`: an ApiCache of records already fetched
+        - `part`: the resource parts to request
+        - `fields`: the fields selector, None for full records
+        - `callback`: called as `callback(ytid, record)` once for every ID
+          added, with the record fetched or still fresh in the cache, or
+          None if there is none; it runs on worker threads
+        """
+        self.key = config.api_key()
         self.buffer = set()
+        self.batch_size = min(batch_size, 50)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        # at most two batches waiting per worker, so the ID's are read as needed
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._out_lock = threading.Lock()
+        self._out = open(OUTPUT_FILE, "a", buffering=1 << 20)
+        self.cache = cache
+        self.part = part
+        self.fields = fields
+        self.callback = callback
+        self.count = 0
+        self.skipped = 0
 
     def add(self, ytid):
-        """Add ID to buffer."""
+        """Add ID to buffer, unless it was fetched recently."""
+        if self.cache is not None and self.cache.is_fresh(ytid):
+            self.skipped += 1
+            if self.callback is not None:
+                self.callback(ytid, self.cache.get(ytid))
+            return
         self.buffer.add(ytid)
-        if len(self.buffer) >= 10:
+        if len(self.buffer) >= self.batch_size:
             self.get()
 
     def get(self):
-        """"Get anything in the buffer."""
+        """"Send anything in the buffer to a worker."""
         if not self.buffer:
             return
+        batch, self.buffer = list(self.buffer), set()
+        self._slots.acquire()
+        future = self._executor.submit(self._fetch, batch)
+        future.add_done_callback(functools.partial(self._done, batch))
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+            session.headers.update({
+                'Accept-Encoding': 'gzip',
+                'User-Agent': 'youtube-data (gzip)',
+            })
+        return session
+
+    def _fetch(self, batch):
+        import requests
         params = {
-            'key': KEY,
-            'part': 'statistics,snippet',
-            'id': ','.join(list(self.buffer))
+            'key': self.key,
+            'part': self.part,
+            'id': ','.join(batch)
         }
-        resp = requests.get(
-            'https://www.googleapis.com/youtube/v3/videos',
-            params=params
-        )
+        if self.fields:
+            params['fields'] = self.fields
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                resp = self._session().get(
+                    'https://www.googleapis.com/youtube/v3/videos',
+                    params=params,
+                    timeout=60
+                )
+            except requests.RequestException as e:
+                reason, wait = str(e), None
+            else:
+                if resp.status_code not in RETRY_STATUSES:
+                    resp.raise_for_status()
+                    return resp.json().get('items', [])
+                reason, wait = "HTTP %d" % resp.status_code, resp.headers.get("Retry-After")
 
-        count = 0
-        with open(OUTPUT_FILE, "a") as fh:
-            for i in resp.json().get('items', []):
-                fh.write(json.dumps(i) + '\n')
-                count += 1
+            if attempt == self.max_attempts:
+                raise RuntimeError("%s after %d attempts" % (reason, attempt))
+            delay = self.base_delay * 2 ** (attempt - 1)
+            if wait and wait.isdigit():
+                delay = max(delay, int(wait))
+            delay *= random.uniform(1.0, 1.5)
+            log("Retrying batch in %.1fs: %s", delay, reason)
+            time.sleep(delay)
 
-        self.buffer = set()
-        log("Retrieved %d records", count)
+    def _done(self, batch, future):
+        self._slots.release()
+        try:
+            items = future.result()
+        except Exception as e:
+            log("Giving up on a batch of ID's: %s", e)
+            items = []
+        else:
+            fetched = time.time()
+            with self._out_lock:
+                for i in items:
+                    i["_fetched"] = fetched
+                    self._out.write(json.dumps(i) + '\n')
+                self.count += len(items)
+            log("Retrieved %d records", len(items))
+
+        if self.callback is not None:
+            found = {i.get("id"): i for i in items}
+            for ytid in batch:
+                self.callback(ytid, found.get(ytid))
+
+    def close(self):
+        """Send the last batch, wait for every request and close the output."""
+        self.get()
+        self._executor.shutdown(wait=True)
+        self._out.close()
 
 
 def main():
     """Entry point."""
-    getter = Getter()
-    for ytid in youtube_id_from_cmdline():
-        getter.add(ytid)
-    getter.get()  # Final flush
+    parser = cmdline_parser()
+    parser.add_argument(
+        "--workers",
+        help="API requests in flight at once (default 4)",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="ID's per API request, at most 50 (default 50)",
+        type=int,
+        default=50
+    )
+    parser.add_argument(
+        "--max-attempts",
+        help="tries per request on quota, rate limit or server errors (default 5)",
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        "--columns",
+        help="comma separated output columns to request from the API (default all of %s)" % ",".join(API_FIELDS),
+        default=None
+    )
+    parser.add_argument(
+        "--full-records",
+        help="store complete API records instead of only the fields combine.py uses",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--ttl-hours",
+        help="skip ID's fetched less than this many hours ago, 0 to fetch all (default %d)" % DEFAULT_TTL_HOURS,
+        type=float,
+        default=DEFAULT_TTL_HOURS
+    )
+    parser.add_argument(
+        "--compact",
+        help="afterwards rewrite the output keeping only the latest record per ID; "
+             "may be used without an input file",
+        action="store_true"
+    )
+    args = parser.parse_args()
+
+    if args.full_records:
+        part, fields = 'statistics,snippet', None
+    else:
+        try:
+            part, fields = projection(args.columns.split(",") if args.columns else None)
+        except ValueError as e:
+            parser.error(str(e))
+
+    cache = ApiCache(OUTPUT_FILE, args.ttl_hours * 3600)
+    try:
+        if args.input or args.csv or not args.compact:
+            yt_ids = youtube_id_from_args(parser, args)
+            log("Indexed %d new lines of %s", cache.refresh(), OUTPUT_FILE)
+
+            getter = Getter(args.batch_size, args.workers, args.max_attempts, cache=cache, part=part, fields=fields)
+            try:
+                for ytid in yt_ids:
+                    getter.add(ytid)
+            finally:
+                getter.close()  # Final flush
+            log("Wrote %d records to %s, skipped %d still fresh", getter.count, OUTPUT_FILE, getter.skipped)
+
+        if args.compact:
+            before, after = cache.compact()
+            log("Compacted %s from %d to %d records", OUTPUT_FILE, before, after)
+    finally:
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -4,31 +4,156 @@
 
 # pylama:ignore=E501
 
+import argparse
+
 # Note that the common import also checks for Python 3
-from common import youtube_id_from_cmdline, log, rel_path
+from common import cmdline_parser, youtube_id_from_args, log
+
+import config
 
 # Make sure these parameters can be imported from another script
-BATCH_FILE = rel_path("batch_ytid.txt")
-OUTPUT_DIR = rel_path("output")
+BATCH_FILE = config.BATCH_FILE
+OUTPUT_DIR = config.OUTPUT_DIR
 
 
-def main():
-    """Entry point."""
-    yt_ids = youtube_id_from_cmdline()
+def positive_float(s):
+    """Argument type for a number greater than zero."""
+    value = float(s)
+    if not value > 0:
+        raise argparse.ArgumentTypeError("must be greater than 0: %s" % s)
+    return value
+
 
+def add_crawl_arguments(parser):
+    """Add the crawler options to an argument parser."""
+    parser.add_argument(
+        "--engine",
+        help="crawl with OS threads or with asyncio over keep-alive connections",
+        choices=["thread", "async"],
+        default="thread"
+    )
+    parser.add_argument(
+        "--inflight",
+        help="concurrent requests for the async engine",
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        "--connections",
+        help="keep-alive connections for the async engine",
+        type=int,
+        default=8
+    )
+    parser.add_argument(
+        "--rate",
+        help="sustained crawl requests per second",
+        type=positive_float,
+        default=1.0
+    )
+    parser.add_argument(
+        "--burst",
+        help="requests allowed back to back before --rate applies",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--adaptive",
+        help="let the crawler tune concurrency and rate from quota errors",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--max-attempts",
+        help="tries per video before giving up until the next run",
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        "--sessions",
+        help="independent YouTube sessions (cookies and token) to spread requests over",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--session-policy",
+        help="how requests are assigned to sessions",
+        choices=["round-robin", "least-throttled"],
+        default="round-robin"
+    )
+    parser.add_argument(
+        "--priority",
+        help="file with one YouTube ID per line to crawl before the others",
+        action="append",
+        default=[]
+    )
+    parser.add_argument(
+        "--storage",
+        help="one file per video, or large append-only segment files",
+        choices=["files", "segments"],
+        default="files"
+    )
+    parser.add_argument(
+        "--compress",
+        help="compress stored responses (zstd needs the zstandard package)",
+        choices=["identity", "gzip", "zstd"],
+        default="identity"
+    )
+    parser.add_argument(
+        "--fsync",
+        help="when crawl logs are forced to disk",
+        choices=["never", "commit", "interval"],
+        default="never"
+    )
+
+
+def write_batch_file(yt_ids, args):
+    """Write the ID's to crawl to BATCH_FILE, sorted."""
     log("Creating batch file: %s", BATCH_FILE)
     with open(BATCH_FILE, "w") as fh:
-        fh.write('\n'.join(list(sorted(yt_ids))))
-        fh.write('\n')
+        # with --external-dedup the ID's already arrive sorted, one at a time
+        for ytid in (yt_ids if args.external_dedup else sorted(yt_ids)):
+            fh.write(ytid)
+            fh.write('\n')
 
-    log("Will use output directory: %s", OUTPUT_DIR)
 
-    log("Starting batch process")
+def make_crawler(args):
+    """Return a Crawler set up from the command line options."""
     from ytcrawl.crawler import Crawler
     c = Crawler()
-    c._crawl_delay_time = 1
+    c.set_rate_limit(args.rate, args.burst)
+    c.set_retry(args.max_attempts)
+    c.set_num_sessions(args.sessions, args.session_policy)
+    c.set_storage(args.storage)
+    c.set_compression(args.compress)
+    c.set_log_policy(fsync=args.fsync)
+    for fn in args.priority:
+        c.add_priority_file(fn)
+    if args.adaptive:
+        c.set_adaptive(min_rate=min(args.rate, 0.1))
     c._cookie_update_delay_time = 1
-    c.batch_crawl(BATCH_FILE, OUTPUT_DIR)
+    return c
+
+
+def run_crawl(c, args):
+    """Crawl every ID in BATCH_FILE with the engine chosen on the command line."""
+    if args.engine == "async":
+        c.batch_crawl_async(BATCH_FILE, OUTPUT_DIR, args.inflight, args.connections)
+    else:
+        c.batch_crawl(BATCH_FILE, OUTPUT_DIR)
+
+
+def main():
+    """Entry point."""
+    parser = cmdline_parser()
+    add_crawl_arguments(parser)
+    args = parser.parse_args()
+    yt_ids = youtube_id_from_args(parser, args)
+
+    write_batch_file(yt_ids, args)
+
+    log("Will use output directory: %s", OUTPUT_DIR)
+
+    log("Starting batch process")
+    run_crawl(make_crawler(args), args)
     log("COMPLETED")
 
 
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""Fetch from the API, crawl and combine all at once.
+
+The API fetcher and the crawler run side by side, each handing every video
+it finishes to a combine stage through a queue. The rows for a video are
+written as soon as both its API record and its crawled data are in, so
+youtube-data.csv and youtube-daily-views.csv fill up while the crawl is
+still running. Takes the same options as do_crawl.py, plus a few for the
+API fetch.
+"""
+
+# pylama:ignore=E501,D213
+
+import queue
+import sys
+import threading
+import time
+
+from common import cmdline_parser, youtube_id_from_args, log, lines
+
+import combine
+import config
+import do_api
+import do_crawl
+
+# Put on the results queue by each producer when it is finished
+END = object()
+
+
+def fetch_api(args, results, errors):
+    """Fetch API records for every ID in the batch file, passing each one on.
+
+    A failure is logged and added to `errors`.
+    """
+    try:
+        cache = do_api.ApiCache(do_api.OUTPUT_FILE, args.ttl_hours * 3600)
+        try:
+            log("Indexed %d new lines of %s", cache.refresh(), do_api.OUTPUT_FILE)
+            part, fields = do_api.projection()
+            getter = do_api.Getter(
+                workers=args.api_workers, cache=cache, part=part, fields=fields,
+                callback=lambda ytid, rec: results.put(("api", ytid, rec)))
+            try:
+                for ytid in lines(do_crawl.BATCH_FILE):
+                    getter.add(ytid)
+            finally:
+                getter.close()
+            log("API fetch finished: %d fetched, %d still fresh", getter.count, getter.skipped)
+        finally:
+            cache.close()
+    except Exception as e:
+        log("API fetch failed: %s", e)
+        errors.append(("API fetch", e))
+    finally:
+        results.put(END)
+
+
+def crawl(args, results, errors):
+    """Crawl every ID in the batch file, passing each response on.
+
+    A failure is logged and added to `errors`.
+    """
+    try:
+        c = do_crawl.make_crawler(args)
+        c.set_result_callback(lambda key, txt: results.put(("crawl", key, txt)))
+        do_crawl.run_crawl(c, args)
+        log("Crawl finished")
+    except Exception as e:
+        log("Crawl failed: %s", e)
+        errors.append(("Crawl", e))
+    finally:
+        results.put(END)
+
+
+def combine_results(results, outputs, producers=2, flush_seconds=10.0):
+    """Write each video's rows once both halves of it have arrived.
+
+    Videos still missing a half when every producer has finished are
+    written with what there is, as combine.py does. A video is written
+    once: further reports for it (say for an ID listed twice) are ignored.
+
+    Arguments:
+    - `results`: the queue of ("api" or "crawl", ytid, record) and END
+    - `outputs`: the combine.Outputs to write to
+    - `producers`: the number of END markers to wait for
+    - `flush_seconds`: how often written rows are pushed to the files
+    """
+    pending = {}
+    written = set()
+    ended, count = 0, 0
+    start = last_flush = time.time()
+    while ended < producers:
+        try:
+            item = results.get(timeout=flush_seconds)
+        except queue.Empty:
+            item = None
+
+        if item is END:
+            ended += 1
+        elif item is not None and item[1] not in written:
+            source, ytid, rec = item
+            data = pending.setdefault(ytid, {})
+            data[source] = True
+            if source == "api" and rec:
+                data["stats"] = rec.get("statistics", {})
+                data["snippet"] = rec.get("snippet", {})
+            elif source == "crawl" and rec:
+                try:
+                    daily_stats, brag_bar = combine.process_crawled(rec.strip())
+                except Exception as e:
+                    # e.g. a consent page: keep going without its crawl half
+                    log("  Skipping [%s], can't parse crawled data: %r", ytid, e)
+                    daily_stats, brag_bar = None, None
+                if daily_stats or brag_bar:
+                    data["daily_stats"] = daily_stats
+                    data["brag_bar"] = brag_bar
+            if "api" in data and "crawl" in data:
+                outputs.write(ytid, pending.pop(ytid))
+                written.add(ytid)
+                count += 1
+
+        now = time.time()
+        if now - last_flush >= flush_seconds:
+            outputs.flush()
+            log("Combined %d videos (%.1f/s), %d waiting for their other half",
+                count, count / (now - start), len(pending))
+            last_flush = now
+
+    log("Writing %d videos with only one half", len(pending))
+    for ytid, data in pending.items():
+        outputs.write(ytid, data)
+
+
+def main():
+    """Entry point."""
+    parser = cmdline_parser()
+    do_crawl.add_crawl_arguments(parser)
+    parser.add_argument(
+        "--api-workers",
+        help="API requests in flight at once (default 4)",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "--ttl-hours",
+        help="skip API records fetched less than this many hours ago (default %d)" % do_api.DEFAULT_TTL_HOURS,
+        type=float,
+        default=do_api.DEFAULT_TTL_HOURS
+    )
+    parser.add_argument(
+        "--format",
+        help="output file format; parquet and arrow need pyarrow (default csv)",
+        choices=sorted(combine.OUTPUT_EXTENSIONS),
+        default="csv"
+    )
+    args = parser.parse_args()
+    config.api_key()  # fail now rather than after the crawl has started
+    yt_ids = youtube_id_from_args(parser, args)
+    do_crawl.write_batch_file(yt_ids, args)
+
+    results = queue.Queue()
+    errors = []
+    producers = [
+        threading.Thread(target=fetch_api, args=(args, results, errors)),
+        threading.Thread(target=crawl, args=(args, results, errors)),
+    ]
+    for t in producers:
+        t.daemon = True
+        t.start()
+
+    outputs = combine.Outputs(args.format)
+    try:
+        combine_results(results, outputs, len(producers))
+    finally:
+        outputs.close()
+    for t in producers:
+        t.join()
+    if errors:
+        # the other stage was left to finish, but the output is incomplete
+        for stage, e in errors:
+            log("FAILED: %s: %s", stage, e)
+        sys.exit(1)
+    log("COMPLETED")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Differential test of the fast brag bar parser against BeautifulSoup.
+
+Run with `python3 -m pytest` (or `python3 -m unittest`) from this
+directory; needs the bs4 package.
+"""
+
+# pylama:ignore=E501,D213
+
+import json
+import unittest
+
+import combine
+
+try:
+    import bs4
+except ImportError:
+    bs4 = None
+
+
+def cell(label, value, td_class="stats-bragbar"):
+    """Return a brag bar cell the way YouTube sends it."""
+    return (
+        '<td class="%s"><span class="metric-label">%s</span>'
+        '<div class="bragbar-metric">%s</div></td>' % (td_class, label, value)
+    )
+
+
+def document(brag_bar_html):
+    """Return a crawled response holding the brag bar HTML."""
+    graph_data = {'day': {'data': [1420070400000]}, 'views': {'daily': {'data': [1]}}}
+    return (
+        '<root><graph_data><![CDATA[%s]]></graph_data>'
+        '<html_content><![CDATA[%s]]></html_content></root>' % (json.dumps(graph_data), brag_bar_html)
+    )
+
+
+# HTML in the shape bragbar_fast handles itself
+FAST_CASES = {
+    "representative": '<table><tr>%s%s%s</tr></table>' % (
+        cell("Views", "1,234,567"), cell("Shares", "89"), cell("Subscriptions driven", "12")),
+    "missing label": '<table><tr>%s%s</tr></table>' % (
+        '<td class="stats-bragbar"><div class="bragbar-metric">5</div></td>', cell("Views", "1")),
+    "missing value": '<td class="stats-bragbar"><span class="metric-label">Views</span></td>',
+    "whitespace": '<table>\n <tr>\n  <td class="stats-bragbar first">\n   <span class="metric-label"> Views </span>\n'
+                  '   <div class="bragbar-metric">\n1,234\n</div>\n  </td>\n </tr>\n</table>',
+    "entities": cell("Time watched &amp; shared", "L&eacute;s &#49;&#x32;"),
+    "other cells": '<table><tr><td class="title">Stats</td>%s</tr></table>' % cell("Views", "7"),
+    "case and quoting": "<TD class='stats-bragbar'><SPAN class=metric-label>Views</SPAN><DIV CLASS=\"bragbar-metric\">3</DIV></TD>",
+    "extra classes": cell("Views", "4", "yt stats-bragbar wide").replace('"metric-label"', '"big metric-label"'),
+}
+
+# HTML bragbar_fast gives up on, leaving it to BeautifulSoup
+FALLBACK_CASES = {
+    "nested markup": '<td class="stats-bragbar"><span class="metric-label">Views <b>all</b></span><div class="bragbar-metric">1</div></td>',
+    "comment": '<!-- brag bar -->%s' % cell("Views", "1"),
+    "unknown child": '<td class="stats-bragbar"><p>x</p><span class="metric-label">Views</span><div class="bragbar-metric">1</div></td>',
+    "stray text": '<td class="stats-bragbar"><span class="metric-label">Views</span>junk<div class="bragbar-metric">1</div></td>',
+    "unclosed cell": '<td class="stats-bragbar"><span class="metric-label">Views</span><div class="bragbar-metric">1</div>',
+    "nested cell": '<td class="stats-bragbar">%s</td>' % cell("Views", "1"),
+    "two class attributes": '<td class="stats-bragbar" class="x"><span class="metric-label">A</span><div class="bragbar-metric">1</div></td>',
+}
+
+# HTML the fast parser once misread without falling back
+MISMATCH_CASES = {
+    "data-class attribute": '<td data-class="x" class="stats-bragbar"><span class="metric-label">A</span><div class="bragbar-metric">1</div></td>',
+    "aria-class attribute": '<td class="stats-bragbar"><span aria-class="y" class="metric-label">A</span><div class="bragbar-metric">1</div></td>',
+    "> in a quoted value": '<td class="stats-bragbar"><span class="metric-label">A</span><div class="bragbar-metric" data-x="a>b">1</div></td>',
+    "> in a quoted cell attribute": '<td title=\'a>b\' class="stats-bragbar"><span class="metric-label">A</span><div class="bragbar-metric">1</div></td>',
+}
+
+
+@unittest.skipIf(bs4 is None, "needs bs4")
+class BragBarTest(unittest.TestCase):
+    """bragbar_fast (with its fallback) must give what bragbar_soup gives."""
+
+    def check(self, name, brag_bar_html):
+        expected = combine.bragbar_soup(brag_bar_html)
+        combine.ALL_BRAG_BAR.clear()
+        daily_stats, brag_bar = combine.process_crawled(document(brag_bar_html))
+        self.assertEqual(brag_bar, expected, name)
+        self.assertEqual(combine.ALL_BRAG_BAR, set(expected), name)
+
+    def test_fast_cases(self):
+        for name, brag_bar_html in FAST_CASES.items():
+            self.assertIsNotNone(combine.bragbar_fast(brag_bar_html), name)
+            self.assertEqual(combine.bragbar_fast(brag_bar_html), combine.bragbar_soup(brag_bar_html), name)
+            self.check(name, brag_bar_html)
+
+    def test_fallback_cases(self):
+        for name, brag_bar_html in FALLBACK_CASES.items():
+            self.assertIsNone(combine.bragbar_fast(brag_bar_html), name)
+            self.check(name, brag_bar_html)
+
+    def test_mismatch_cases(self):
+        for name, brag_bar_html in MISMATCH_CASES.items():
+            fast = combine.bragbar_fast(brag_bar_html)
+            if fast is not None:
+                self.assertEqual(fast, combine.bragbar_soup(brag_bar_html), name)
+            self.check(name, brag_bar_html)
+
+    def test_labels_over_many_responses(self):
+        combine.ALL_BRAG_BAR.clear()
+        expected = set()
+        for brag_bar_html in list(FAST_CASES.values()) + list(FALLBACK_CASES.values()) + list(MISMATCH_CASES.values()):
+            combine.process_crawled(document(brag_bar_html))
+            expected.update(combine.bragbar_soup(brag_bar_html))
+        self.assertEqual(combine.ALL_BRAG_BAR, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
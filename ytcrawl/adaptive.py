@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""Additive-increase/multiplicative-decrease control of crawl concurrency and rate."""
+
+# License: BSD 3 clause
+
+import asyncio
+import collections
+import threading
+
+
+class ConcurrencyLimit(object):
+    """A semaphore whose limit can be changed while it is in use.
+
+    Threads use `acquire`/`release`; coroutines use `acquire_async` and
+    `release_async`. A single crawl only uses one of the two, and the async
+    methods (and `set_limit` during an async crawl) must be called from the
+    event loop's thread.
+    """
+
+    def __init__(self, limit):
+        """init.
+
+        Arguments:
+        - `limit`: the initial number of concurrent holders
+        """
+        self._limit = max(1, int(limit))
+        self._active = 0
+        self._cond = threading.Condition()
+        self._waiters = collections.deque()
+
+    @property
+    def limit(self):
+        """The current limit."""
+        return self._limit
+
+    def set_limit(self, limit):
+        """Change the limit, waking waiters if it was raised."""
+        with self._cond:
+            self._limit = max(1, int(limit))
+            self._cond.notify_all()
+        self._wake_async()
+
+    def acquire(self):
+        """Block until the number of holders is under the limit."""
+        with self._cond:
+            while self._active >= self._limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        """Give back a slot taken with `acquire`."""
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    async def acquire_async(self):
+        """Wait until the number of holders is under the limit."""
+        while self._active >= self._limit:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            await fut
+        self._active += 1
+
+    def release_async(self):
+        """Give back a slot taken with `acquire_async`."""
+        self._active -= 1
+        self._wake_async()
+
+    def _wake_async(self):
+        free = self._limit - self._active
+        while free > 0 and self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+
+class AIMDController(object):
+    """Drive a ConcurrencyLimit and a TokenBucket from response outcomes.
+
+    Outcomes are counted in windows of `window` responses. A window whose
+    share of throttling errors (quota exceeded, invalid request) is above
+    `error_threshold` multiplies both the concurrency and the rate by
+    `decrease`; a clean window adds `concurrency_step` and `rate_step`. Over a
+    long crawl this saw-tooths just under the highest sustainable throughput.
+    """
+
+    def __init__(self, limit, bucket,
+                 min_concurrency=1, max_concurrency=20,
+                 min_rate=0.1, max_rate=20.0,
+                 concurrency_step=1, rate_step=0.1,
+                 decrease=0.5, error_threshold=0.05, window=50):
+        """init.
+
+        Arguments:
+        - `limit`: the ConcurrencyLimit to adjust
+        - `bucket`: the TokenBucket to adjust
+        - `min_concurrency`, `max_concurrency`: concurrency bounds
+        - `min_rate`, `max_rate`: request rate bounds (per second)
+        - `concurrency_step`, `rate_step`: additive increase per clean window
+        - `decrease`: multiplicative factor applied on a throttled window
+        - `error_threshold`: share of throttled responses that triggers a cut
+        - `window`: number of responses per decision
+        """
+        if not 0 < min_rate <= max_rate:
+            raise ValueError('need 0 < min_rate <= max_rate')
+
+        self._lock = threading.Lock()
+        self._limit = limit
+        self._bucket = bucket
+
+        self._min_concurrency = min_concurrency
+        self._max_concurrency = max_concurrency
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._concurrency_step = concurrency_step
+        self._rate_step = rate_step
+        self._decrease = decrease
+        self._error_threshold = error_threshold
+        self._window = window
+
+        self._count = 0
+        self._errors = 0
+        self._last_error_rate = 0.0
+        self._cuts = 0
+
+    def record(self, throttled):
+        """Record one response outcome.
+
+        Arguments:
+        - `throttled`: True for a quota or invalid-request error
+        """
+        with self._lock:
+            self._count += 1
+            if throttled:
+                self._errors += 1
+            if self._count < self._window:
+                return
+            error_rate = self._errors / self._count
+            self._count, self._errors = 0, 0
+            self._last_error_rate = error_rate
+
+            concurrency, rate = self._limit.limit, self._bucket.rate
+            cut = error_rate > self._error_threshold
+            if cut:
+                concurrency = max(self._min_concurrency, int(concurrency * self._decrease))
+                rate = max(self._min_rate, rate * self._decrease)
+                self._cuts += 1
+            else:
+                concurrency = min(self._max_concurrency, concurrency + self._concurrency_step)
+                rate = min(self._max_rate, rate + self._rate_step)
+
+        self._limit.set_limit(concurrency)
+        self._bucket.set_rate(rate)
+        if cut:
+            print("Throttled (%.1f%% errors), backing off to %s" % (100.0 * error_rate, self.describe()))
+
+    @property
+    def limit(self):
+        """The ConcurrencyLimit this controller adjusts."""
+        return self._limit
+
+    def operating_point(self):
+        """Return the current concurrency, rate and last window's error rate."""
+        return {
+            'concurrency': self._limit.limit,
+            'rate': self._bucket.rate,
+            'error_rate': self._last_error_rate,
+            'cuts': self._cuts,
+        }
+
+    def describe(self):
+        """Return the operating point as a short human readable string."""
+        op = self.operating_point()
+        return "concurrency=%d rate=%.2f/s" % (op['concurrency'], op['rate'])
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""Compression of crawled responses in transit and at rest."""
+
+# License: BSD 3 clause
+
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Encodings we can store, and the file name extension marking each one
+EXTENSIONS = {
+    'identity': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def available(encoding):
+    """Return True if payloads can be written and read with the encoding."""
+    if encoding == 'zstd':
+        return zstandard is not None
+    return encoding in EXTENSIONS
+
+
+def compress(data, encoding):
+    """Compress bytes with the given encoding."""
+    if encoding == 'identity':
+        return data
+    if encoding == 'gzip':
+        return gzip.compress(data)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError('unknown encoding %s' % encoding)
+
+
+def decompress(data, encoding):
+    """Decompress bytes that were compressed with the given encoding.
+
+    Also accepts the HTTP Content-Encoding names 'x-gzip' and 'deflate'.
+    """
+    encoding = (encoding or 'identity').lower()
+    if encoding == 'identity':
+        return data
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.decompress(data)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # some servers send a raw deflate stream without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('reading zstd data needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError('unknown encoding %s' % encoding)
+
+
+def split_name(fn):
+    """Split a stored file name into (key, encoding) using its extension."""
+    for encoding, ext in EXTENSIONS.items():
+        if ext and fn.endswith(ext):
+            return fn[:-len(ext)], encoding
+    return fn, 'identity'
@@ -7,27 +7,32 @@
 # Author: Honglin Yu <yuhonglin1986@gmail.com>
 # License: BSD 3 clause
 
+import asyncio
 import urllib.request
 import urllib.error
 import urllib.parse
-from urllib.request import Request, build_opener, HTTPCookieProcessor, HTTPHandler
 import threading
 import os
-import time
 import datetime
-import re
-import http.cookiejar
 
 from os.path import join
 
+from . import codec
+from .adaptive import AIMDController, ConcurrencyLimit
+from .feeder import KeyFeeder
+from .httppool import ConnectionPool
 from .logger import Logger
+from .ratelimit import TokenBucket
+from .retry import RetryScheduler
+from .segstore import SegmentReader, SegmentStore, migrate_tree
+from .session import SessionPool, open_session
 from .xmlparser import parseString
 
 
 class Crawler(object):
     """The crawler class.
 
-    - for batch_crawl:
+    - for batch_crawl and batch_crawl_async:
         - input is a file
         - output is a directory
     - for single_crawl
@@ -38,19 +43,39 @@ class Crawler(object):
     def __init__(self):
         """ctor."""
         self._input_file = None
+        self._priority_files = []
+        self._feeder = None
+        self._queue_size = 10000
+        self._active_keys = set()
+        self._skipped_done = 0
+
+        self._storage = 'files'
+        self._segments = None
+        self._segment_reader = None
+        self._compression = 'identity'
+        self._result_callback = None
         self._output_dir = None
 
         self._num_thread = 20
 
         self._logger = None
+        self._log_options = {}
 
         self._key_done = None
 
-        self._mutex_crawl = threading.Lock()
-        self._delay_mutex = None
+        self._rate_limiter = None
+        self._controller = None
+        self._adaptive_options = None
 
-        self._cookie = ''
-        self._session_token = ''
+        self._retry = RetryScheduler()
+        self._dispatch = threading.Condition()
+        self._in_flight = 0
+        self._input_done = False
+
+        self._sessions = None
+        self._num_sessions = 1
+        self._session_policy = 'round-robin'
+        self._seed_videoIDs = None
 
         self._is_done = False
 
@@ -64,6 +89,7 @@ class Crawler(object):
         self._cookie_update_delay_time = 0.1
 
         self._cookie_update_on = False
+        self._session_lock = threading.Lock()
 
         self._seed_videoID = 'OQSNhk5ICTI'
 
@@ -91,27 +117,188 @@ class Crawler(object):
         """
         self._seed_videoID = vID
 
-    def mutex_delay(self, t):
-        """Delay some time.
+    def set_seed_videoIDs(self, vIDs):
+        """Set one seed videoID per session; at least that many sessions are used.
+
+        Arguments:
+        - `vIDs`: list of video IDs
+        """
+        self._seed_videoIDs = list(vIDs)
+
+    def set_num_sessions(self, n, policy='round-robin'):
+        """Use `n` independent sessions (cookies and token), default is 1.
+
+        Seed videos are reused in turn when there are fewer than `n`. A
+        session that keeps getting throttled is retired and replaced while
+        the others carry on.
+
+        Arguments:
+        - `n`: number of sessions
+        - `policy`: 'round-robin' or 'least-throttled'
+        """
+        self._num_sessions = n
+        self._session_policy = policy
+
+    def add_priority_file(self, fn):
+        """Crawl the keys in this file before those in the batch input file.
+
+        Arguments:
+        - `fn`: a file with one key per line
+        """
+        with open(fn):
+            pass  # fail now rather than in the feeder thread mid-crawl
+        self._priority_files.append(fn)
+
+    def set_queue_size(self, n):
+        """Set how many keys may wait between the feeder and the workers, default is 10000.
+
+        Arguments:
+        - `n`: the queue bound
+        """
+        self._queue_size = n
+
+    def set_rate_limit(self, rate, burst=1):
+        """Limit crawling to `rate` requests per second.
+
+        Without this the rate is 1 / `_crawl_delay_time`. The limit may be
+        changed while a crawl is running.
+
+        Arguments:
+        - `rate`: sustained requests per second
+        - `burst`: the most requests allowed back to back
+        """
+        if self._rate_limiter is None:
+            self._rate_limiter = TokenBucket(rate, burst)
+        else:
+            self._rate_limiter.set_rate(rate, burst)
+
+    def set_adaptive(self, **options):
+        """Let an AIMD controller choose the concurrency and the request rate.
+
+        Clean responses raise both additively; a share of quota or
+        invalid-request errors above the threshold cuts them
+        multiplicatively. The number of threads (or `max_inflight` for the
+        async engine) becomes the upper bound on concurrency. Keyword
+        options are passed on to `AIMDController`.
+        """
+        self._adaptive_options = options
+
+    def set_retry(self, max_attempts=5, base_delay=2.0, max_delay=300.0):
+        """Control how failed keys are retried within a crawl.
+
+        Quota errors, invalid requests and exceptions put the key back in a
+        backoff queue; it is dropped after `max_attempts` tries.
+
+        Arguments:
+        - `max_attempts`: tries per key (1 disables retries)
+        - `base_delay`: seconds before the first retry, doubled each time
+        - `max_delay`: the longest delay before a retry
+        """
+        self._retry = RetryScheduler(max_attempts, base_delay, max_delay)
+
+    @property
+    def controller(self):
+        """The AIMDController in use, or None when not adaptive."""
+        return self._controller
+
+    @property
+    def rate_limiter(self):
+        """The TokenBucket pacing requests (None until a crawl starts)."""
+        return self._rate_limiter
+
+    def set_storage(self, storage):
+        """Choose how crawled responses are stored, default is 'files'.
+
+        - 'files': one file per key under `output/data/k[0]/k[1]/k[2]/k`
+        - 'segments': appended to large segment files under `output/segments`;
+          any existing `output/data` tree is moved into them first
+
+        Arguments:
+        - `storage`: 'files' or 'segments'
+        """
+        if storage not in ('files', 'segments'):
+            raise ValueError('unknown storage %s' % storage)
+        self._storage = storage
+
+    def set_compression(self, encoding):
+        """Choose how stored responses are compressed, default is 'identity' (none).
+
+        With 'gzip' a response the server already sent gzipped is stored
+        as received; 'zstd' needs the zstandard package. Files get a `.gz`
+        or `.zst` extension and segment records carry the encoding.
 
         Arguments:
-        - `t`: the time in minutes
+        - `encoding`: 'identity', 'gzip' or 'zstd'
         """
-        self._delay_mutex.acquire()
-        time.sleep(t)
-        self._delay_mutex.release()
+        if not codec.available(encoding):
+            raise ValueError('compression %s is not available' % encoding)
+        self._compression = encoding
 
-    def store(self, k, txt):
-        """Generate the filepath of the output file of key "k".
+    def set_log_policy(self, flush_interval=0.5, batch_size=1000, fsync='never'):
+        """Set how the crawl logs are group-committed (see `Logger`).
+
+        Arguments:
+        - `flush_interval`: the most seconds a log line waits to be written
+        - `batch_size`: the most lines written in one commit
+        - `fsync`: 'never', 'commit' or 'interval'
+        """
+        self._log_options = {'flush_interval': flush_interval, 'batch_size': batch_size, 'fsync': fsync}
+
+    def set_result_callback(self, callback):
+        """Call `callback(key, txt)` once for every key of the batch that is finished.
+
+        `txt` is the response (decoded) for keys crawled now or stored by an
+        earlier run, and None for keys skipped, given up on or invalid. The
+        callback runs on crawl threads, so it should be quick (e.g. put the
+        result on a queue).
+        """
+        self._result_callback = callback
+
+    def _report(self, key, txt):
+        if self._result_callback is not None:
+            self._result_callback(key, txt)
+
+    def load(self, k):
+        """Return the stored response for key "k" as text, or None."""
+        if self._segments is not None:
+            if self._segment_reader is None:
+                self._segment_reader = SegmentReader(join(self._output_dir, 'segments'))
+            data = self._segment_reader.get(k)
+            return None if data is None else data.decode('utf-8')
+
+        outdir = join(self._output_dir, 'data', k[0], k[1], k[2])
+        for encoding, ext in codec.EXTENSIONS.items():
+            fn = join(outdir, k + ext)
+            if os.path.exists(fn):
+                with open(fn, 'rb') as fh:
+                    return codec.decompress(fh.read(), encoding).decode('utf-8')
+        return None
+
+    def store(self, k, txt, raw=None, encoding='identity'):
+        """Store the response for key "k".
 
         Arguments:
         - `k`: the key
         - `txt`: the file content
+        - `raw`: the response body as received, if available
+        - `encoding`: the Content-Encoding of `raw`
         """
+        if raw is not None and encoding == self._compression:
+            data = raw  # already what we store: don't re-encode txt
+        elif self._compression == 'identity':
+            data = txt.encode('utf-8')
+        else:
+            data = codec.compress(txt.encode('utf-8'), self._compression)
+
+        if self._segments is not None:
+            self._segments.append(k, data, self._compression)
+            return
+
         outdir = join(self._output_dir, 'data', k[0], k[1], k[2])
         if not os.path.exists(outdir):
             os.makedirs(outdir)
-        open(join(outdir, k), 'w').write(txt)
+        with open(join(outdir, k + codec.EXTENSIONS[self._compression]), 'wb') as fh:
+            fh.write(data)
 
     def get_url(self, k):
         """Get the URL.
@@ -122,172 +309,330 @@ class Crawler(object):
         return 'https://www.youtube.com/insight_ajax?action_get_statistics_and_data=1&v=' + k
 
     def update_cookie_and_sectiontoken(self):
-        """Cookie tracking for crawling."""
-        # if already begin to update
-        if self._cookie_update_on:
-            return
+        """Cookie tracking for crawling.
 
-        self._cookie_update_on = True
-        self.period_update()
+        Opens the session pool. A caller arriving while another thread is
+        opening it waits until that is done.
+        """
+        with self._session_lock:
+            # if already begin to update
+            if self._cookie_update_on:
+                return
+
+            seeds = self._seed_videoIDs or [self._seed_videoID]
+            n = max(self._num_sessions, len(seeds))
+            sessions = SessionPool(self.new_session, [seeds[i % len(seeds)] for i in range(n)], self._session_policy)
+            sessions.start()
+            self._sessions = sessions
+            self._cookie_update_on = True
+        self._last_cookie_update_time = datetime.datetime.now()
+        self._schedule_update()
+
+    def _schedule_update(self):
+        self._current_update_cookie_timer = threading.Timer(self._update_cookie_period, self.period_update)
+        self._current_update_cookie_timer.daemon = True
+        self._current_update_cookie_timer.start()
 
     def period_update(self):
-        """Periodic update during crawl."""
+        """Periodic update during crawl.
+
+        Each session in the pool is rebuilt and tested on the side while
+        workers keep using the current one, then swapped in. If a refresh
+        fails the current session is kept until the next period.
+        """
         # all the job is done
         if self._is_done:
             return
-        # begin to update
-        self._mutex_crawl.acquire()
-
-        i = 0
-        state = 'fail'
-        while i < self._update_cookie_maximum_times:
-            # get cookies
-            cj = http.cookiejar.CookieJar()
-            opener = build_opener(HTTPCookieProcessor(cj), HTTPHandler())
-            req = Request("https://www.youtube.com/watch?v="+self._seed_videoID)
-            f = opener.open(req)
-            # note that we assume UTF-8 encoding from YouTube
-            src = f.read().decode('utf-8')
-
-            time.sleep(self._cookie_update_delay_time)
-
-            cookiename = ['YSC', 'PREF', 'VISITOR_INFO1_LIVE', 'ACTIVITY']
-            self._cookie = ''
-            for cookie in cj:
-                if cookie.name in cookiename:
-                    self._cookie += (cookie.name + '=' + cookie.value + '; ')
-            self._cookie = self._cookie[0:-2]
-
-            re_st = re.compile('\'XSRF_TOKEN\'\: \"([^\"]+)\"\,')
-            try:
-                self._session_token = re_st.findall(src)[0]
-            except Exception as e:
-                print(re_st.findall(src))
-                print(e)
-                print(src)
-                raise
+
+        self._sessions.refresh_all()
+        self._last_cookie_update_time = datetime.datetime.now()
+        self._schedule_update()
+
+    def get_session(self):
+        """Return the Session the next request should use."""
+        if self._sessions is None:
+            self.update_cookie_and_sectiontoken()
+        return self._sessions.get()
+
+    def new_session(self, seed_videoID):
+        """Open a new session from the seed video and check it works.
+
+        Arguments:
+        - `seed_videoID`: the video used to get the cookies and token
+        """
+        last_error = None
+        for i in range(self._update_cookie_maximum_times):
+            session = open_session(seed_videoID, self._cookie_update_delay_time)
 
             # test
             try:
-                self.single_crawl(self._seed_videoID)
+                self.single_crawl(seed_videoID, session)
             except Exception as e:
                 if 'Invalid request' in str(e):
+                    last_error = e
                     continue
-                else:
-                    self._mutex_crawl.release()
-                    raise Exception('meet error when update the cookies, please set a new seed video (%s)' % str(e))
-
-            state = 'success'
-            break
-
-        if state == 'fail':
-            self._mutex_crawl.release()
-            raise Exception('times of updating cookies reaches maximum, please report this on github (%s)' % str(e))
+                raise Exception('meet error when update the cookies, please set a new seed video (%s)' % str(e))
 
-        self._mutex_crawl.release()
+            return session
 
-        self._last_cookie_update_time = datetime.datetime.now()
-
-        self._current_update_cookie_timer = threading.Timer(self._update_cookie_period, self.update_cookie_and_sectiontoken)
-        self._current_update_cookie_timer.daemon = True
-        self._current_update_cookie_timer.start()
+        raise Exception('times of updating cookies reaches maximum, please report this on github (%s)' % str(last_error))
 
-    def get_header(self, k):
+    def get_header(self, k, session=None):
         """Construct proper headers."""
+        session = session or self.get_session()
         headers = {}
         headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
-        # headers['Accept-Encoding'] = 'gzip, deflate'
+        headers['Accept-Encoding'] = 'gzip, deflate'
         headers['Accept-Language'] = 'en-US,en;q=0.5'
         headers['Content-Length'] = '280'
         headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=UTF-8'
-        headers['Cookie'] = self._cookie
+        headers['Cookie'] = session.cookie
         headers['Host'] = 'www.youtube.com'
         headers['Referer'] = 'https://www.youtube.com/watch?v=' + k
         headers['User-Agent'] = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0'
 
         return headers
 
-    def get_post_data(self):
+    def get_post_data(self, session=None):
         """Create post data."""
-        return bytes(urllib.parse.urlencode({'session_token': self._session_token}), 'utf-8')
+        session = session or self.get_session()
+        return bytes(urllib.parse.urlencode({'session_token': session.token}), 'utf-8')
 
     def check_key(self, k):
         """Insure key is OK."""
         return len(k) == 11
 
-    def crawl_thread(self, keyfile):
-        """The function to iterate through the keyfile and try to download the data.
+    def accept_key(self, key):
+        """Return True if the key still needs crawling, logging why not otherwise."""
+        # Done keys are counted, not logged: a line per key on every run
+        # would make the log, and each resume's import of it, keep growing
+        if key in self._key_done:
+            self._skipped_done += 1
+            if self._result_callback is not None:
+                self._report(key, self.load(key))
+            return False
+
+        if not self.check_key(key):
+            self._logger.log_warn(key, "Key is incorrect")
+            self._report(key, None)
+            return False
+
+        # the same key may be listed again (e.g. in a priority file) while
+        # it is still queued, being crawled or waiting for a retry. Not
+        # logged: every key in the 'log' file counts as done on resume
+        if key in self._active_keys:
+            return False
+
+        self._active_keys.add(key)
+        return True
+
+    def _start_controller(self, max_concurrency):
+        """Create the adaptive controller for a crawl if one was requested."""
+        if self._adaptive_options is None:
+            return
+        options = dict(self._adaptive_options)
+        options.setdefault('max_concurrency', max_concurrency)
+        options.setdefault('max_rate', max(self._rate_limiter.rate, 1.0) * 10)
+        start = options.get('min_concurrency', 1)
+        self._controller = AIMDController(ConcurrencyLimit(start), self._rate_limiter, **options)
+
+    def _end_request(self, key, outcome, session):
+        """Feed a response outcome back to the controller, sessions and retry queue.
 
         Arguments:
-        - `keyfile`:
+        - `key`: the key that was crawled
+        - `outcome`: the result of `handle_response`, None on an exception
+        - `session`: the Session the request was made with
+        """
+        if outcome is not None:
+            self._sessions.report(session, outcome == 'error')
+            if self._controller is not None:
+                self._controller.record(outcome == 'error')
+
+        if outcome in (None, 'error'):
+            attempts = self._retry.attempts(key) + 1
+            if not self._retry.schedule(key):
+                self._logger.log_warn(key, 'Giving up after %d attempts' % attempts, 'error')
+                self._active_keys.discard(key)
+                self._report(key, None)
+        else:
+            self._retry.forget(key)
+            self._active_keys.discard(key)
+
+    def _next_key(self):
+        """Return the next key to crawl, or None when all work is finished.
+
+        Due retries come first, then keys from the feeder. Once the feeder is
+        exhausted this waits for keys still being crawled or waiting to be
+        retried, since either may still produce work.
         """
         while True:
-            # read a line from the file
-            self._mutex_crawl.acquire()
-            kf = keyfile.readline()
-            self._mutex_crawl.release()
-
-            if kf == '':
-                # the keyfile is finished
-                self._is_done = True
-                break
+            with self._dispatch:
+                key = self._retry.pop_due()
+                if key is not None:
+                    self._in_flight += 1
+                    return key
+
+                if self._input_done:
+                    if self._in_flight == 0 and len(self._retry) == 0:
+                        self._is_done = True
+                        self._dispatch.notify_all()
+                        return None
+                    wait = self._retry.next_due()
+                    self._dispatch.wait(1.0 if wait is None else min(wait, 1.0))
+                    continue
+
+                # count the key as in flight before we have it so that no
+                # other worker can see an empty pipeline in the meantime
+                self._in_flight += 1
 
-            key = kf.strip()
+            key = self._feeder.get(timeout=0.5)
+            if key is not None and key is not KeyFeeder.END:
+                return key
 
-            if key in self._key_done:
-                self._logger.log_warn(key, "Skipping prev completed key")
-                continue
+            with self._dispatch:
+                self._in_flight -= 1
+                if key is KeyFeeder.END:
+                    self._input_done = True
+                self._dispatch.notify_all()
 
-            if not self.check_key(key):
-                self._logger.log_warn(key, "Key is incorrect")
-                continue
+    def _key_finished(self):
+        """Mark a key returned by `_next_key` as no longer in flight."""
+        with self._dispatch:
+            self._in_flight -= 1
+            self._dispatch.notify_all()
 
-            url = self.get_url(key)
-            data = self.get_post_data()
-            header = self.get_header(key)
+    def crawl_thread(self):
+        """The function to take keys from the feeder and try to download the data."""
+        while True:
+            key = self._next_key()
+            if key is None:
+                break
 
-            txt = ''
+            session, outcome = None, None
+            if self._controller is not None:
+                self._controller.limit.acquire()
             try:
-                self.mutex_delay(self._crawl_delay_time)
+                # take the session once so cookie and token always match
+                session = self.get_session()
+                url = self.get_url(key)
+                data = self.get_post_data(session)
+                header = self.get_header(key, session)
+
+                self._rate_limiter.acquire()
                 request = urllib.request.Request(url, data, headers=header)
-                txt = urllib.request.urlopen(request).read().decode('utf-8')
+                response = urllib.request.urlopen(request)
+                raw = response.read()
+                encoding = response.headers.get('Content-Encoding', 'identity')
+                txt = codec.decompress(raw, encoding).decode('utf-8')
+                outcome = self.handle_response(key, txt, raw, encoding)
+            except Exception as e:
+                self._logger.log_warn(key, str(e), 'error')
+            finally:
+                if self._controller is not None:
+                    self._controller.limit.release()
+                self._end_request(key, outcome, session)
+                self._key_finished()
 
-                if '<p>Public statistics have been disabled.</p>' in txt:
-                    self._logger.log_warn(key, 'statistics disabled', 'skipped')
-                    self._key_done.add(key)
-                    continue
+    def handle_response(self, key, txt, raw=None, encoding='identity'):
+        """Classify a response, then log and store it accordingly.
 
-                if '<error_message><![CDATA[Video not found.]]></error_message>' in txt:
-                    self._logger.log_warn(key, 'Video not found', 'skipped')
-                    self._key_done.add(key)
-                    continue
+        Returns 'done', 'skipped' or 'error'.
 
-                if 'No statistics available yet' in txt:
-                    self._logger.log_warn(key, 'No statistics available yet', 'skipped')
-                    self._key_done.add(key)
-                    continue
+        Arguments:
+        - `key`: the key that was crawled
+        - `txt`: the decoded response body
+        - `raw`: the response body as received
+        - `encoding`: the Content-Encoding of `raw`
+        """
+        if '<p>Public statistics have been disabled.</p>' in txt:
+            self._logger.log_warn(key, 'statistics disabled', 'skipped')
+            self._key_done.add(key)
+            self._report(key, None)
+            return 'skipped'
 
-                if '<error_message><![CDATA[Video is private.]]></error_message>' in txt:
-                    self._logger.log_warn(key, 'Private video', 'skipped')
-                    self._key_done.add(key)
-                    continue
+        if '<error_message><![CDATA[Video not found.]]></error_message>' in txt:
+            self._logger.log_warn(key, 'Video not found', 'skipped')
+            self._key_done.add(key)
+            self._report(key, None)
+            return 'skipped'
 
-                # These aren't considered done
-                if '<error_message><![CDATA[Sorry, quota limit exceeded, please retry later.]]></error_message>' in txt:
-                    self._logger.log_warn(key, 'Quota limit exceeded', 'error')
-                    continue
+        if 'No statistics available yet' in txt:
+            self._logger.log_warn(key, 'No statistics available yet', 'skipped')
+            self._key_done.add(key)
+            self._report(key, None)
+            return 'skipped'
 
-                if '<error_message><![CDATA[Invalid request.]]></error_message>' in txt:
-                    self._logger.log_warn(key, 'Invalid request', 'error')
-                    continue
+        if '<error_message><![CDATA[Video is private.]]></error_message>' in txt:
+            self._logger.log_warn(key, 'Private video', 'skipped')
+            self._key_done.add(key)
+            self._report(key, None)
+            return 'skipped'
+
+        # These aren't considered done
+        if '<error_message><![CDATA[Sorry, quota limit exceeded, please retry later.]]></error_message>' in txt:
+            self._logger.log_warn(key, 'Quota limit exceeded', 'error')
+            return 'error'
 
-                # If we're still here we actually finished
-                self._logger.log_done(key)
-                self.store(key, txt)
-                self._key_done.add(key)
+        if '<error_message><![CDATA[Invalid request.]]></error_message>' in txt:
+            self._logger.log_warn(key, 'Invalid request', 'error')
+            return 'error'
+
+        # If we're still here we actually finished
+        # the response is stored before the key is logged as done, so a
+        # crash in between only means the key is crawled again
+        self.store(key, txt, raw, encoding)
+        self._logger.log_done(key)
+        self._key_done.add(key)
+        self._report(key, txt)
+        return 'done'
+
+    def _begin_batch(self, input_file, output_dir):
+        """Set up the feeder, the logs and the sessions shared by both engines."""
+        self._input_file = input_file
+        self._output_dir = output_dir
 
-            except Exception as e:
-                self._logger.log_warn(key, str(e))
+        self._logger = Logger(self._output_dir, **self._log_options)
+        self._logger.add_log({'skipped': 'key.skipped', 'error': 'key.errors'})
+        self._key_done = self._logger.get_key_done(['skipped'])
+        print("Already retrieved %d keys" % len(self._key_done))
+        self._skipped_done = 0
+
+        if self._storage == 'segments':
+            self._segments = SegmentStore(join(self._output_dir, 'segments'))
+            data_dir = join(self._output_dir, 'data')
+            if os.path.isdir(data_dir):
+                print("Moving %s into segments" % data_dir)
+                print("Moved %d files" % migrate_tree(data_dir, self._segments))
+
+        self._feeder = KeyFeeder(self.accept_key, self._queue_size)
+        for fn in self._priority_files:
+            self._feeder.add_source(fn, -1)
+        self._feeder.add_source(self._input_file)
+
+        if self._rate_limiter is None:
+            self.set_rate_limit(1.0 / self._crawl_delay_time)
+
+        self.update_cookie_and_sectiontoken()
+
+    def _end_batch(self):
+        """Stop the cookie timer and the feeder."""
+        self._is_done = True
+        if self._current_update_cookie_timer is not None:
+            self._current_update_cookie_timer.cancel()
+        self._feeder.stop()
+        print("Skipped %d previously completed keys" % self._skipped_done)
+        if self._segments is not None:
+            self._segments.close()
+            self._segments = None
+        if self._segment_reader is not None:
+            self._segment_reader.close()
+            self._segment_reader = None
+        self._logger.close()
+        print("Crawl rate limit %.2f/s, observed %.2f/s" % (
+            self._rate_limiter.rate, self._rate_limiter.observed_rate()))
+        if self._controller is not None:
+            print("Adaptive operating point: %s" % self._controller.describe())
 
     def batch_crawl(self,  input_file, output_dir):
         """Perform a full batch crawl.
@@ -296,45 +641,142 @@ class Crawler(object):
         - `input_file`: the file that includes the keys (e.g. video IDs)
         - `output_dir`: the dir to output crawled data
         """
-        self._input_file = open(input_file)
-        self._output_dir = output_dir
-
-        self._logger = Logger(self._output_dir)
-        self._logger.add_log({'skipped': 'key.skipped', 'error': 'key.errors'})
-        self._key_done = self._logger.get_key_done(['skipped'])
-        print("Already retrieved %d keys" % len(self._key_done))
+        self._begin_batch(input_file, output_dir)
+        self._start_controller(self._num_thread)
+        self._feeder.start()
 
-        self._delay_mutex = threading.Lock()
-
-        self.update_cookie_and_sectiontoken()
         threads = []
         for i in range(0, self._num_thread):
-            threads.append(threading.Thread(target=self.crawl_thread, args=(self._input_file, )))
+            threads.append(threading.Thread(target=self.crawl_thread))
 
         for t in threads:
             t.start()
         for t in threads:
             t.join()
 
-        self._current_update_cookie_timer.cancel()
+        self._end_batch()
+        if self._feeder.error is not None:
+            # the input was not read to the end: don't let this pass as done
+            raise self._feeder.error
 
-    def single_crawl(self, key):
+    def batch_crawl_async(self, input_file, output_dir, max_inflight=1000, pool_size=8):
+        """Perform a full batch crawl with asyncio instead of threads.
+
+        Up to `max_inflight` requests are outstanding at once, all sharing
+        `pool_size` keep-alive connections. Output layout and resume files
+        are the same as for `batch_crawl`.
+
+        Arguments:
+        - `input_file`: the file that includes the keys (e.g. video IDs)
+        - `output_dir`: the dir to output crawled data
+        - `max_inflight`: the number of concurrent requests
+        - `pool_size`: the number of persistent connections
+        """
+        self._begin_batch(input_file, output_dir)
+        self._start_controller(max_inflight)
+        self._feeder.start()
+        try:
+            asyncio.run(self._async_crawl(max_inflight, pool_size))
+        finally:
+            self._end_batch()
+        if self._feeder.error is not None:
+            raise self._feeder.error
+
+    async def _async_crawl(self, max_inflight, pool_size):
+        """Feed keys from the input file to `max_inflight` coroutines."""
+        pool = ConnectionPool(urllib.parse.urlsplit(self.get_url('')).hostname, 443, pool_size)
+        queue = asyncio.Queue(max_inflight)
+        # keys queued or being crawled, any of which may come back as a retry
+        pending = [0]
+
+        async def worker():
+            while True:
+                key = await queue.get()
+                if key is None:
+                    return
+                try:
+                    await self._async_crawl_key(pool, key)
+                finally:
+                    pending[0] -= 1
+
+        async def put(key):
+            pending[0] += 1
+            await queue.put(key)
+
+        async def put_due_retries():
+            key = self._retry.pop_due()
+            while key is not None:
+                await put(key)
+                key = self._retry.pop_due()
+
+        workers = [asyncio.ensure_future(worker()) for i in range(max_inflight)]
+        loop = asyncio.get_event_loop()
+        try:
+            # keys are read and checked (a done-store lookup each) by the
+            # feeder thread; wait for them off the event loop
+            while True:
+                key = await loop.run_in_executor(None, self._feeder.get, 0.5)
+                if key is KeyFeeder.END:
+                    break
+                if key is not None:
+                    await put(key)
+                await put_due_retries()
+
+            while pending[0] or len(self._retry):
+                await put_due_retries()
+                wait = self._retry.next_due()
+                await asyncio.sleep(0.1 if wait is None else min(max(wait, 0.01), 1.0))
+
+            for w in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            pool.close()
+
+    async def _async_crawl_key(self, pool, key):
+        """Download and handle one key over the connection pool."""
+        session, outcome = None, None
+        if self._controller is not None:
+            await self._controller.limit.acquire_async()
+        try:
+            session = self.get_session()
+            url = urllib.parse.urlsplit(self.get_url(key))
+            data = self.get_post_data(session)
+            header = self.get_header(key, session)
+
+            await self._rate_limiter.acquire_async()
+            status, rheaders, body = await pool.request('POST', url.path + '?' + url.query, header, data)
+            encoding = rheaders.get('content-encoding', 'identity')
+            txt = codec.decompress(body, encoding).decode('utf-8')
+            outcome = self.handle_response(key, txt, body, encoding)
+        except Exception as e:
+            self._logger.log_warn(key, str(e), 'error')
+        finally:
+            if self._controller is not None:
+                self._controller.limit.release_async()
+            self._end_request(key, outcome, session)
+
+    def single_crawl(self, key, session=None):
         """Crawl video.
 
         Arguments:
         - `key`: videoID
+        - `session`: the Session to use instead of the current one
         """
-        if self._last_cookie_update_time is None:
-            self.update_cookie_and_sectiontoken()
+        if session is None:
+            session = self.get_session()
 
         url = self.get_url(key)
-        data = self.get_post_data()
-        header = self.get_header(key)
+        data = self.get_post_data(session)
+        header = self.get_header(key, session)
 
         txt = ''
 
         request = urllib.request.Request(url, data, headers=header)
-        txt = urllib.request.urlopen(request).read().decode('utf-8')
+        response = urllib.request.urlopen(request)
+        txt = codec.decompress(response.read(), response.headers.get('Content-Encoding')).decode('utf-8')
 
         if '<p>Public statistics have been disabled.</p>' in txt:
             raise Exception('statistics disabled')
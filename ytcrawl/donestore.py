@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""A persistent, indexed set of crawled keys used to resume a crawl."""
+
+# License: BSD 3 clause
+
+import os
+import sqlite3
+import threading
+
+
+class DoneStore(object):
+    """A set of keys kept in an indexed SQLite table.
+
+    Membership checks are index lookups, so resuming does not need to read
+    the whole crawl history into memory. The text logs remain the record of
+    what happened: `import_log` adds only the lines appended to a log since
+    it was last imported, so startup cost depends on the last run rather
+    than on every run before it.
+    """
+
+    def __init__(self, path, commit_every=1000):
+        """init.
+
+        Arguments:
+        - `path`: the SQLite database file
+        - `commit_every`: number of `add` calls between commits
+        """
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS done (key TEXT PRIMARY KEY) WITHOUT ROWID')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS imported (path TEXT PRIMARY KEY, offset INTEGER)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'count'").fetchone()
+        self._count = row[0] if row else self._conn.execute('SELECT COUNT(*) FROM done').fetchone()[0]
+        self._conn.commit()
+
+        self._commit_every = commit_every
+        self._pending = 0
+
+    def __contains__(self, key):
+        """Return True if the key is done."""
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM done WHERE key = ?', (key, )).fetchone() is not None
+
+    def __len__(self):
+        """Return the number of keys done."""
+        return self._count
+
+    def add(self, key):
+        """Mark a key as done."""
+        with self._lock:
+            self._insert([key])
+            self._pending += 1
+            if self._pending >= self._commit_every:
+                self._commit()
+
+    def _insert(self, keys):
+        before = self._conn.total_changes
+        self._conn.executemany('INSERT OR IGNORE INTO done (key) VALUES (?)', ((k, ) for k in keys))
+        self._count += self._conn.total_changes - before
+
+    def _commit(self):
+        self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('count', ?)", (self._count, ))
+        self._conn.commit()
+        self._pending = 0
+
+    def import_log(self, path, parse):
+        """Add the keys from lines appended to a log since its last import.
+
+        If the log is now shorter than what was imported it was replaced,
+        and it is imported again from the start.
+
+        Arguments:
+        - `path`: the log file, tracked by its name within the directory
+        - `parse`: called with each line, returns its key (or None to skip)
+        """
+        if not os.path.exists(path):
+            return
+        with self._lock:
+            name = os.path.basename(path)
+            row = self._conn.execute('SELECT offset FROM imported WHERE path = ?', (name, )).fetchone()
+            offset = row[0] if row else 0
+            if offset > os.path.getsize(path):
+                offset = 0
+
+            with open(path, 'rb') as fh:
+                fh.seek(offset)
+                batch = []
+                for line in fh:
+                    if not line.endswith(b'\n'):
+                        break  # a line still being written
+                    offset += len(line)
+                    key = parse(line.decode('utf-8', 'replace'))
+                    if key:
+                        batch.append(key)
+                    if len(batch) >= 10000:
+                        self._insert(batch)
+                        batch = []
+                self._insert(batch)
+
+            self._conn.execute('INSERT OR REPLACE INTO imported (path, offset) VALUES (?, ?)', (name, offset))
+            self._commit()
+
+    def close(self):
+        """Commit any pending keys and close the database."""
+        with self._lock:
+            self._commit()
+            self._conn.close()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""Stream keys from input files into a bounded work queue."""
+
+# License: BSD 3 clause
+
+import queue
+import threading
+
+
+class KeyFeeder(object):
+    """Read keys from one or more files, filter them and queue them for workers.
+
+    Files are read a line at a time in priority order (lower first, then in
+    the order they were added), so no file is ever held in memory. Keys
+    rejected by `accept` never reach a worker. The queue is bounded, so the
+    feeder only runs `maxsize` keys ahead of the workers. If reading fails
+    in the background thread, END is still queued and the exception is
+    kept in `error` for the caller to raise.
+    """
+
+    END = object()
+
+    def __init__(self, accept, maxsize=10000):
+        """init.
+
+        Arguments:
+        - `accept`: called with each key, returns False to drop it
+        - `maxsize`: the most keys waiting in the queue
+        """
+        self._accept = accept
+        self._sources = []
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._stop = False
+        self.error = None
+
+    def add_source(self, filename, priority=0):
+        """Add a file of keys, one per line.
+
+        Arguments:
+        - `filename`: the file to read
+        - `priority`: files with a lower priority are read first
+        """
+        self._sources.append((priority, len(self._sources), filename))
+
+    def keys(self):
+        """Yield every accepted key from every source in priority order."""
+        for priority, i, filename in sorted(self._sources):
+            with open(filename) as fh:
+                for line in fh:
+                    if self._stop:
+                        return
+                    key = line.strip()
+                    if self._accept(key):
+                        yield key
+
+    def start(self):
+        """Start filling the queue from a background thread."""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for key in self.keys():
+                self._queue.put(key)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._queue.put(self.END)
+
+    def get(self, timeout=None):
+        """Return the next key, `KeyFeeder.END` when all sources are done, or None on timeout."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        """Stop reading and wait for the feeder thread to finish.
+
+        Waiting matters because `accept` may use resources the caller is
+        about to close, like the crawler's SQLite done store. The queue is
+        drained meanwhile so the thread can't stay blocked on a full one.
+        """
+        self._stop = True
+        if self._thread is None:
+            return
+        while self._thread.is_alive():
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(0.1)
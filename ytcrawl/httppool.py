@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501,C901
+
+"""A small asyncio HTTP/1.1 client with a pool of keep-alive connections."""
+
+# License: BSD 3 clause
+
+import asyncio
+import ssl
+
+
+class HTTPError(Exception):
+    """Raised for a non-2xx response (mirrors urllib's HTTPError message)."""
+
+    def __init__(self, status, reason):
+        """init."""
+        super().__init__('HTTP Error %d: %s' % (status, reason))
+        self.status = status
+        self.reason = reason
+
+
+class _Connection(object):
+    """One persistent connection to the pool's host."""
+
+    def __init__(self, reader, writer):
+        """init."""
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def close(self):
+        """Close the underlying transport."""
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """Keep-alive connections to a single host shared by many coroutines.
+
+    Any number of coroutines may call `request` at once; at most `size` of
+    them hold a connection at the same time and the rest wait for one to be
+    handed back. Idle connections are reused, so the TCP+TLS handshake is
+    only paid when a connection is first opened or the server drops it.
+    """
+
+    def __init__(self, host, port=443, size=8, use_ssl=True, timeout=60):
+        """init.
+
+        Arguments:
+        - `host`: the host every request goes to
+        - `port`: the port to connect to
+        - `size`: the maximum number of open connections
+        - `use_ssl`: wrap the connections in TLS
+        - `timeout`: seconds allowed for one request/response exchange
+        """
+        self._host = host
+        self._port = port
+        self._size = size
+        self._ssl = ssl.create_default_context() if use_ssl else None
+        self._timeout = timeout
+
+        self._idle = []
+        self._slots = None
+        self._closed = False
+
+    @property
+    def size(self):
+        """Maximum number of open connections."""
+        return self._size
+
+    async def _acquire(self):
+        if self._slots is None:
+            # created lazily so that it binds to the running loop
+            self._slots = asyncio.Semaphore(self._size)
+        await self._slots.acquire()
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.reader.at_eof():
+                conn.reused = True
+                return conn
+            conn.close()
+        try:
+            reader, writer = await asyncio.open_connection(self._host, self._port, ssl=self._ssl)
+        except BaseException:
+            self._slots.release()
+            raise
+        return _Connection(reader, writer)
+
+    def _release(self, conn, keep):
+        if keep and not self._closed:
+            self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    async def request(self, method, path, headers, body=b''):
+        """Send one request and return `(status, headers, body)`.
+
+        Response header names are lower-cased. A non-2xx status raises
+        `HTTPError`.
+
+        Arguments:
+        - `method`: e.g. 'GET' or 'POST'
+        - `path`: the path and query string
+        - `headers`: dict of request headers
+        - `body`: the request body as bytes
+        """
+        # A reused connection may have been closed by the server while idle;
+        # in that case retry once on a fresh connection.
+        for attempt in range(2):
+            conn = await self._acquire()
+            keep = False
+            try:
+                status, reason, rheaders, rbody, keep = await asyncio.wait_for(
+                    self._exchange(conn, method, path, headers, body),
+                    self._timeout
+                )
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self._release(conn, False)
+                if conn.reused and attempt == 0:
+                    continue
+                raise ConnectionError('connection to %s failed (%s)' % (self._host, str(e)))
+            except BaseException:
+                self._release(conn, False)
+                raise
+            self._release(conn, keep)
+            if status < 200 or status >= 300:
+                raise HTTPError(status, reason)
+            return status, rheaders, rbody
+
+    async def _exchange(self, conn, method, path, headers, body):
+        lines = ['%s %s HTTP/1.1' % (method, path)]
+        hdrs = dict(headers)
+        hdrs['Host'] = self._host
+        hdrs['Connection'] = 'keep-alive'
+        hdrs['Content-Length'] = str(len(body))
+        for k, v in hdrs.items():
+            lines.append('%s: %s' % (k, v))
+        conn.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await conn.writer.drain()
+
+        reader = conn.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('server closed the connection')
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+
+        rheaders = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise ConnectionError('server closed the connection')
+            name, _, value = line.decode('latin-1').partition(':')
+            rheaders[name.strip().lower()] = value.strip()
+
+        keep = rheaders.get('connection', '').lower() != 'close'
+        if 'chunked' in rheaders.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size_line = await reader.readline()
+                if not size_line.endswith(b'\n'):
+                    raise ConnectionError('server closed the connection mid-chunk')
+                size = int(size_line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # discard any trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            rbody = b''.join(chunks)
+        elif 'content-length' in rheaders:
+            rbody = await reader.readexactly(int(rheaders['content-length']))
+        else:
+            rbody = await reader.read()
+            keep = False
+
+        return status, reason, rheaders, rbody, keep
+
+    def close(self):
+        """Close all idle connections; in-use ones close when released."""
+        self._closed = True
+        while self._idle:
+            self._idle.pop().close()
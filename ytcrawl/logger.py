@@ -8,14 +8,58 @@
 
 import time
 import os
+import queue
+import threading
 from os.path import join
 
+from .donestore import DoneStore
+
+
+FSYNC_POLICIES = ('never', 'commit', 'interval')
+
+# Messages once logged for every key skipped, ignored by `get_key_done`
+SKIP_NOTICES = frozenset(['Skipping prev completed key', 'Skipping key already queued'])
+
 
 class Logger(object):
-    """record the crawling status, error and warnings."""
+    """record the crawling status, error and warnings.
+
+    Lines are handed to a single writer thread through a queue and written
+    in group commits: whatever has arrived (up to `batch_size` lines) is
+    written and flushed together at most every `flush_interval` seconds.
+    Only the writer thread touches the files, so every line is written
+    whole and lines from different crawl threads never interleave.
+
+    The fsync policy says when commits are forced to disk:
+
+    - 'never': leave it to the OS (the default)
+    - 'commit': after every group commit
+    - 'interval': at most once every `fsync_interval` seconds
+
+    With 'interval', lines left unsynced when logging goes quiet are synced
+    once the interval is up, without waiting for more lines. Whatever the
+    policy, a crash can lose at most the last unwritten lines and a torn
+    final line, which the resume import skips.
+
+    If a write or fsync fails the writer thread carries on draining the
+    queue, and the first error is raised from `flush` and `close`.
+    """
+
+    _STOP = object()
+
+    def __init__(self, outputDir="", flush_interval=0.5, batch_size=1000, fsync='never', fsync_interval=10.0):
+        """init.
+
+        Arguments:
+        - `outputDir`: the dir holding the logs
+        - `flush_interval`: the most seconds a line waits before it is written
+        - `batch_size`: the most lines written in one group commit
+        - `fsync`: 'never', 'commit' or 'interval' (see the class docstring)
+        - `fsync_interval`: seconds between fsyncs for the 'interval' policy
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy %s' % fsync)
 
-    def __init__(self, outputDir=""):
-        """init."""
         self._output_dir = outputDir
         if not os.path.exists(self._output_dir):
             os.makedirs(self._output_dir)
@@ -27,6 +71,21 @@ class Logger(object):
         self._done_name = join(self._output_dir, 'key.done')
         self._done_file = open(self._done_name, 'a+')
 
+        self._done_store = None
+
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._last_fsync = time.time()
+        self._unsynced = False
+        self._error = None
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
     def add_log(self, d):
         """Add a log file."""
         for i, j in d.items():
@@ -34,27 +93,38 @@ class Logger(object):
             self._log_name_dict[i] = fn
             self._log_file_dict[i] = open(fn, 'a+')
 
-    def _read_done_keys(self):
-        with open(self._done_name, "r") as fh:
-            return set([i.strip() for i in fh.read().split() if i.strip()])
-
-    def _read_logged_keys(self, name):
-        with open(self._log_name_dict[name], "r") as fh:
-            return set([line.split(',')[1] for line in fh if line.strip()])
+    @staticmethod
+    def _parse_done_line(line):
+        return line.strip()
+
+    @staticmethod
+    def _parse_logged_line(line):
+        fields = line.split(',')
+        if len(fields) < 2:
+            return None
+        # per-key skip notices written by older versions say nothing new
+        # (or, for a key listed twice, wrongly marked it done)
+        if ','.join(fields[2:]).strip() in SKIP_NOTICES:
+            return None
+        return fields[1]
 
     def get_key_done(self, lognames=[]):
-        """Get the keys that have been crawled."""
-        ks = self._read_done_keys() | self._read_logged_keys('log')
-        for name in lognames:
-            ks = ks | self._read_logged_keys(name)
-        return ks
+        """Get the keys that have been crawled.
+
+        The result is a set-like DoneStore kept in `key.done.db`. Only what
+        was appended to the text logs since the last call is read from them.
+        """
+        if self._done_store is None:
+            self._done_store = DoneStore(join(self._output_dir, 'key.done.db'))
+        self.flush()
+        self._done_store.import_log(self._done_name, self._parse_done_line)
+        for name in ['log'] + list(lognames):
+            self._done_store.import_log(self._log_name_dict[name], self._parse_logged_line)
+        return self._done_store
 
     def log_done(self, k):
         """Thread safe finalizer for logs."""
-        # self._mutex_done.acquire()
-        self._done_file.write('%s\n' % k)
-        self._done_file.flush()
-        # self._mutex_done.release()
+        self._queue.put((self._done_file, '%s\n' % k))
 
     def log_warn(self, k, m, lfk='log'):
         """Log message as warning.
@@ -64,13 +134,104 @@ class Logger(object):
         - `m`: the message
         - `lfk`: log_file_key
         """
-        # self._mutex_log.acquire()
         msg = ','.join([
             time.strftime('%Y-%m-%d %m:%H:%M'),
             k,
             m
         ])
-        outp = self._log_file_dict[lfk]
-        outp.write(msg + '\n')
-        outp.flush()
-        # self._mutex_log.release()
+        self._queue.put((self._log_file_dict[lfk], msg + '\n'))
+
+    def flush(self):
+        """Wait until every line logged so far has been written and flushed."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _next_item(self):
+        # with unsynced lines under the 'interval' policy, wake up when the
+        # interval is up even if nothing else is logged (None)
+        if self._fsync == 'interval' and self._unsynced:
+            timeout = max(0.0, self._last_fsync + self._fsync_interval - time.time())
+            try:
+                return self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return None
+        return self._queue.get()
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            item = self._next_item()
+            if item is None:
+                try:
+                    self._commit(())
+                except Exception as e:
+                    self._error = self._error or e
+                continue
+
+            batch = [item]
+            deadline = time.time() + self._flush_interval
+            while len(batch) < self._batch_size and not isinstance(batch[-1], threading.Event) and batch[-1] is not self._STOP:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            touched = set()
+            waiters = [item for item in batch if isinstance(item, threading.Event)]
+            stop = any(item is self._STOP for item in batch)
+            # on an error keep going, so flush() and close() never hang and
+            # other files still get their lines; they raise the error
+            for item in batch:
+                if item is not self._STOP and not isinstance(item, threading.Event):
+                    fh, line = item
+                    try:
+                        fh.write(line)
+                        touched.add(fh)
+                    except Exception as e:
+                        self._error = self._error or e
+            try:
+                self._commit(touched, final=stop)
+            except Exception as e:
+                self._error = self._error or e
+            for w in waiters:
+                w.set()
+
+    def _commit(self, files, final=False):
+        for fh in files:
+            fh.flush()
+        if self._fsync == 'never':
+            return
+        if self._fsync == 'interval':
+            if files:
+                self._unsynced = True
+            if not final and time.time() - self._last_fsync < self._fsync_interval:
+                return
+            files = list(self._log_file_dict.values()) + [self._done_file]
+        try:
+            for fh in files:
+                os.fsync(fh.fileno())
+        finally:
+            # a failed sync is retried an interval later, not in a busy loop
+            self._last_fsync = time.time()
+        self._unsynced = False
+
+    def close(self):
+        """Write out the queued lines, then close the log files and the done-key store."""
+        self._queue.put(self._STOP)
+        self._writer.join()
+        for fh in self._log_file_dict.values():
+            fh.close()
+        self._done_file.close()
+        if self._done_store is not None:
+            self._done_store.close()
+            self._done_store = None
+        self._raise_error()
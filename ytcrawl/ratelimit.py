@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""Token bucket rate limiting shared by the threaded and asyncio crawlers."""
+
+# License: BSD 3 clause
+
+import asyncio
+import collections
+import threading
+import time
+
+
+def _positive_rate(rate):
+    """Return the rate as a float, refusing rates that would never refill."""
+    rate = float(rate)
+    if not rate > 0:
+        raise ValueError('rate must be positive, got %s' % rate)
+    return rate
+
+
+class TokenBucket(object):
+    """Limit requests to a sustained rate while allowing short bursts.
+
+    The bucket holds at most `burst` tokens and refills at `rate` tokens per
+    second. Taking a token reserves the next free slot under a short lock and
+    then sleeps *outside* the lock, so any number of waiters queue up in
+    order without serializing on a mutex held across a sleep.
+    """
+
+    def __init__(self, rate, burst=1, window=10.0):
+        """init.
+
+        Arguments:
+        - `rate`: sustained requests per second
+        - `burst`: the most requests allowed back to back
+        - `window`: seconds of history used by `observed_rate`
+        """
+        self._lock = threading.Lock()
+        self._rate = _positive_rate(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._window = window
+        self._grants = collections.deque()
+
+    @property
+    def rate(self):
+        """The configured sustained rate in requests per second."""
+        return self._rate
+
+    @property
+    def burst(self):
+        """The configured burst size."""
+        return self._burst
+
+    def set_rate(self, rate, burst=None):
+        """Change the sustained rate (and optionally the burst size).
+
+        Arguments:
+        - `rate`: sustained requests per second
+        - `burst`: the most requests allowed back to back
+        """
+        rate = _positive_rate(rate)
+        with self._lock:
+            self._refill(time.monotonic())
+            self._rate = rate
+            if burst is not None:
+                self._burst = float(burst)
+                self._tokens = min(self._tokens, self._burst)
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+
+            self._grants.append(now + wait)
+            while self._grants and self._grants[0] < now - self._window:
+                self._grants.popleft()
+            return wait
+
+    def acquire(self):
+        """Block the calling thread until a token is available."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait without blocking the event loop until a token is available."""
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def observed_rate(self):
+        """Return the requests per second granted over the recent window."""
+        with self._lock:
+            now = time.monotonic()
+            n = sum(1 for t in self._grants if now - self._window <= t <= now)
+            return n / self._window
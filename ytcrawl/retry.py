@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""Time-ordered retry queue with jittered exponential backoff."""
+
+# License: BSD 3 clause
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class RetryScheduler(object):
+    """Hold failed keys until their backoff delay has passed.
+
+    The n-th retry of a key is delayed by a random time between half and all
+    of `base_delay * 2 ** (n - 1)` (capped at `max_delay`), so keys that
+    failed together do not all come back together. A key is given up after
+    `max_attempts` failures.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2.0, max_delay=300.0):
+        """init.
+
+        Arguments:
+        - `max_attempts`: failures allowed per key before giving up
+        - `base_delay`: seconds before the first retry
+        - `max_delay`: upper bound on the delay before any retry
+        """
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._attempts = {}
+
+    def __len__(self):
+        """Return the number of keys waiting to be retried."""
+        return len(self._heap)
+
+    def attempts(self, key):
+        """Return the number of failures recorded for the key."""
+        return self._attempts.get(key, 0)
+
+    def schedule(self, key):
+        """Record a failure and queue the key for a retry.
+
+        Returns False (and forgets the key) if it has used all its attempts.
+        """
+        with self._lock:
+            n = self._attempts.get(key, 0) + 1
+            if n >= self._max_attempts:
+                self._attempts.pop(key, None)
+                return False
+            self._attempts[key] = n
+
+            delay = min(self._max_delay, self._base_delay * 2 ** (n - 1))
+            delay = random.uniform(delay / 2, delay)
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), key))
+            return True
+
+    def forget(self, key):
+        """Drop the attempt count of a key that has succeeded."""
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def pop_due(self):
+        """Return a key whose delay has passed, or None."""
+        with self._lock:
+            if self._heap and self._heap[0][0] <= time.monotonic():
+                return heapq.heappop(self._heap)[2]
+            return None
+
+    def next_due(self):
+        """Return the seconds until the next key is due, or None if empty."""
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - time.monotonic())
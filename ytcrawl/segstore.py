@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""Append-only segment files holding many crawled responses each."""
+
+# License: BSD 3 clause
+
+import os
+import re
+import threading
+
+from os.path import join
+
+from .codec import decompress, split_name
+
+
+SEGMENT_RE = re.compile(r'^segment-(\d+)\.dat$')
+
+
+def segment_name(n):
+    """Return the file name of segment number n."""
+    return 'segment-%06d.dat' % n
+
+
+def list_segments(directory):
+    """Return the segment numbers found in the directory, in order."""
+    if not os.path.isdir(directory):
+        return []
+    nums = []
+    for fn in os.listdir(directory):
+        m = SEGMENT_RE.match(fn)
+        if m:
+            nums.append(int(m.group(1)))
+    return sorted(nums)
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as fh:
+        fh.seek(-1, os.SEEK_END)
+        return fh.read(1) == b'\n'
+
+
+def _read_header(fh):
+    """Read a record header, returning [key, length, encoding] or None at the end."""
+    header = fh.readline()
+    if not header.endswith(b'\n'):
+        return None
+    parts = header.decode('ascii').split()
+    if len(parts) == 2:
+        parts.append('identity')
+    elif len(parts) != 3:
+        return None
+    return parts
+
+
+class SegmentStore(object):
+    """Write records to large rolling segment files plus an offset index.
+
+    Each record is a header line `<key> <length> <encoding>\\n`, the payload
+    and a newline, so segments can be scanned without the index. The index
+    file has one line `<key> <segment> <offset> <length> <encoding>` per
+    record and is used for random lookup. A key stored twice is resolved by
+    the later record. The encoding (see `codec`) says how the payload is
+    compressed; records written before it existed have none and are plain.
+
+    Every store opens a fresh segment, so a record torn by a crash is only
+    ever at the end of a segment that is no longer written to.
+    """
+
+    def __init__(self, directory, segment_size=256 * 1024 * 1024):
+        """init.
+
+        Arguments:
+        - `directory`: where the segments and index live
+        - `segment_size`: bytes after which a new segment is started
+        """
+        self._directory = directory
+        self._segment_size = segment_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        existing = list_segments(directory)
+        self._segment = (existing[-1] + 1) if existing else 0
+        self._fh = open(join(directory, segment_name(self._segment)), 'ab')
+        self._size = 0
+        index = join(directory, 'index')
+        self._index = open(index, 'a')
+        if self._index.tell() and not _ends_with_newline(index):
+            # end a line torn by a crash so it can't run into the next one
+            self._index.write('\n')
+
+    def append(self, key, data, encoding='identity'):
+        """Append one record; safe to call from many threads.
+
+        Arguments:
+        - `key`: the record key (e.g. a YouTube ID), without whitespace
+        - `data`: the payload as bytes
+        - `encoding`: how the payload is compressed
+        """
+        header = ('%s %d %s\n' % (key, len(data), encoding)).encode('ascii')
+        with self._lock:
+            if self._size and self._size + len(header) + len(data) + 1 > self._segment_size:
+                self._roll()
+            offset = self._size + len(header)
+            self._fh.write(header)
+            self._fh.write(data)
+            self._fh.write(b'\n')
+            self._fh.flush()
+            self._size += len(header) + len(data) + 1
+            # the index line goes after the data so it never points at a
+            # record that is not fully written
+            self._index.write('%s %d %d %d %s\n' % (key, self._segment, offset, len(data), encoding))
+            self._index.flush()
+
+    def _roll(self):
+        self._fh.close()
+        self._segment += 1
+        self._fh = open(join(self._directory, segment_name(self._segment)), 'ab')
+        self._size = 0
+
+    def sync(self):
+        """Flush the current segment and the index to disk."""
+        with self._lock:
+            os.fsync(self._fh.fileno())
+            os.fsync(self._index.fileno())
+
+    def close(self):
+        """Close the current segment and the index."""
+        with self._lock:
+            self._fh.close()
+            self._index.close()
+
+
+class SegmentReader(object):
+    """Read records written by a SegmentStore.
+
+    `scan` walks the segments in order and needs no index; `get` loads the
+    index on first use for random lookup by key.
+    """
+
+    def __init__(self, directory):
+        """init.
+
+        Arguments:
+        - `directory`: the SegmentStore directory
+        """
+        self._directory = directory
+        self._offsets = None
+        self._handles = {}
+
+    def _load_index(self):
+        # A line torn by a crash may still split into valid looking fields,
+        # so lines must be complete and point inside their segment
+        offsets = {}
+        sizes = {}
+        fn = join(self._directory, 'index')
+        if os.path.exists(fn):
+            with open(fn) as fh:
+                for line in fh:
+                    parts = line.split()
+                    if not line.endswith('\n'):
+                        continue  # torn final line
+                    if len(parts) == 4:
+                        parts.append('identity')
+                    elif len(parts) != 5:
+                        continue
+                    try:
+                        segment, offset, length = int(parts[1]), int(parts[2]), int(parts[3])
+                    except ValueError:
+                        continue
+                    if segment not in sizes:
+                        path = join(self._directory, segment_name(segment))
+                        sizes[segment] = os.path.getsize(path) if os.path.exists(path) else -1
+                    if offset + length + 1 > sizes[segment]:
+                        continue  # past the end of what was written
+                    offsets[parts[0]] = (segment, offset, length, parts[4])
+        self._offsets = offsets
+
+    def __contains__(self, key):
+        """Return True if the key has a record."""
+        if self._offsets is None:
+            self._load_index()
+        return key in self._offsets
+
+    def __len__(self):
+        """Return the number of distinct keys in the index."""
+        if self._offsets is None:
+            self._load_index()
+        return len(self._offsets)
+
+    def keys(self):
+        """Return the keys in the index."""
+        if self._offsets is None:
+            self._load_index()
+        return self._offsets.keys()
+
+    def get_raw(self, key):
+        """Return `(payload, encoding)` as stored for the key, or None."""
+        if self._offsets is None:
+            self._load_index()
+        loc = self._offsets.get(key)
+        if loc is None:
+            return None
+        segment, offset, length, encoding = loc
+        fh = self._handles.get(segment)
+        if fh is None:
+            fh = open(join(self._directory, segment_name(segment)), 'rb')
+            self._handles[segment] = fh
+        fh.seek(offset)
+        return fh.read(length), encoding
+
+    def get(self, key):
+        """Return the latest (decompressed) payload stored for the key, or None."""
+        rec = self.get_raw(key)
+        if rec is None:
+            return None
+        return decompress(*rec)
+
+    def scan(self):
+        """Yield `(key, payload)` for every record in write order, decompressed.
+
+        A key stored more than once is yielded each time; the last one wins.
+        """
+        for key, data, encoding in self.scan_raw():
+            yield key, decompress(data, encoding)
+
+    def scan_raw(self):
+        """Yield `(key, payload, encoding)` for every record as stored."""
+        for n in list_segments(self._directory):
+            for rec in self.scan_segment_raw(n):
+                yield rec
+
+    def scan_segment_raw(self, n):
+        """Yield `(key, payload, encoding)` for every record in segment n."""
+        with open(join(self._directory, segment_name(n)), 'rb') as fh:
+            while True:
+                parts = _read_header(fh)
+                if parts is None:
+                    break
+                length = int(parts[1])
+                data = fh.read(length)
+                if len(data) != length or fh.read(1) != b'\n':
+                    break  # torn record at the end of a segment
+                yield parts[0], data, parts[2]
+
+    def locate_segment(self, n):
+        """Yield `(key, offset, length, encoding)` for every record in segment n.
+
+        Like `scan_segment_raw`, but payloads are skipped rather than read,
+        so the caller can look at them in place (say through an mmap).
+        """
+        path = join(self._directory, segment_name(n))
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fh:
+            while True:
+                parts = _read_header(fh)
+                if parts is None:
+                    break
+                length = int(parts[1])
+                offset = fh.tell()
+                if offset + length >= size:
+                    break  # torn record at the end of a segment
+                fh.seek(offset + length)
+                if fh.read(1) != b'\n':
+                    break
+                yield parts[0], offset, length, parts[2]
+
+    def close(self):
+        """Close any segment files opened by `get`."""
+        for fh in self._handles.values():
+            fh.close()
+        self._handles = {}
+
+
+def migrate_tree(data_dir, store):
+    """Move every file of a `data/k[0]/k[1]/k[2]/k` tree into a SegmentStore.
+
+    Files are deleted a directory at a time once their records are synced
+    to disk, so an interrupted migration can simply be run again. Returns
+    the number of files moved.
+
+    Arguments:
+    - `data_dir`: the root of the per-video file tree
+    - `store`: the SegmentStore to append to
+    """
+    count = 0
+    for path, subdirs, files in os.walk(data_dir, topdown=False):
+        for fn in files:
+            key, encoding = split_name(fn)
+            with open(join(path, fn), 'rb') as fh:
+                store.append(key, fh.read(), encoding)
+        store.sync()
+        for fn in files:
+            os.remove(join(path, fn))
+        count += len(files)
+        if path != data_dir:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+    return count
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D213,E501
+
+"""The cookie and session token pairs the crawler sends with each request."""
+
+# License: BSD 3 clause
+
+import http.cookiejar
+import re
+import threading
+import time
+
+from urllib.request import Request, build_opener, HTTPCookieProcessor, HTTPHandler
+
+
+COOKIE_NAMES = ['YSC', 'PREF', 'VISITOR_INFO1_LIVE', 'ACTIVITY']
+
+XSRF_TOKEN_RE = re.compile('\'XSRF_TOKEN\'\\: \"([^\"]+)\"\\,')
+
+
+class Session(object):
+    """An immutable cookie/XSRF token pair.
+
+    Sessions are never modified in place: a refresh builds a new Session and
+    the crawler swaps its reference to it, so a worker that read the old one
+    keeps a consistent cookie and token for the request it is making. The
+    attributes are read-only; `in_slot` returns a copy placed in a pool slot.
+    """
+
+    __slots__ = ('_cookie', '_token', '_seed_videoID', '_created', '_slot')
+
+    def __init__(self, cookie, token, seed_videoID, slot=None, created=None):
+        """init.
+
+        Arguments:
+        - `cookie`: the Cookie header value
+        - `token`: the XSRF session token posted with each request
+        - `seed_videoID`: the video whose watch page issued them
+        - `slot`: the SessionPool slot holding it, if any
+        - `created`: when it was opened, default now
+        """
+        self._cookie = cookie
+        self._token = token
+        self._seed_videoID = seed_videoID
+        self._slot = slot
+        self._created = time.time() if created is None else created
+
+    cookie = property(lambda self: self._cookie, doc="The Cookie header value.")
+    token = property(lambda self: self._token, doc="The XSRF session token.")
+    seed_videoID = property(lambda self: self._seed_videoID, doc="The video whose watch page issued the session.")
+    created = property(lambda self: self._created, doc="When the session was opened (time.time()).")
+    slot = property(lambda self: self._slot, doc="The SessionPool slot holding the session, or None.")
+
+    def in_slot(self, slot):
+        """Return a copy of the session placed in the given pool slot."""
+        return Session(self._cookie, self._token, self._seed_videoID, slot, self._created)
+
+
+def open_session(seed_videoID, delay=0.1):
+    """Load the seed video's watch page and return a new, untested Session.
+
+    Arguments:
+    - `seed_videoID`: the video whose watch page is loaded
+    - `delay`: seconds to pause after the page is loaded
+    """
+    cj = http.cookiejar.CookieJar()
+    opener = build_opener(HTTPCookieProcessor(cj), HTTPHandler())
+    req = Request("https://www.youtube.com/watch?v=" + seed_videoID)
+    f = opener.open(req)
+    # note that we assume UTF-8 encoding from YouTube
+    src = f.read().decode('utf-8')
+
+    time.sleep(delay)
+
+    cookie = '; '.join(c.name + '=' + c.value for c in cj if c.name in COOKIE_NAMES)
+
+    tokens = XSRF_TOKEN_RE.findall(src)
+    if not tokens:
+        raise Exception('can not find XSRF_TOKEN in the watch page of %s' % seed_videoID)
+
+    return Session(cookie, tokens[0], seed_videoID)
+
+
+class _Slot(object):
+    """One place in a SessionPool and the state used to pick it."""
+
+    def __init__(self, index, seed_videoID):
+        self.index = index
+        self.seed_videoID = seed_videoID
+        self.session = None
+        self.last_used = 0.0
+        self.last_throttled = 0.0
+        self.strikes = 0
+        self.retired = False
+        self.refreshing = False
+
+
+class SessionPool(object):
+    """Several independent sessions handed out to workers in turn.
+
+    Each slot has its own cookie jar, token and seed video. Workers take a
+    session with `get` and report how the request went with `report`. A
+    slot whose session is throttled `retire_after` times in a row is retired:
+    it is skipped by `get` while a replacement is opened in the background,
+    then the new session is swapped in. The other slots carry on meanwhile.
+    """
+
+    POLICIES = ('round-robin', 'least-throttled')
+
+    def __init__(self, factory, seed_videoIDs, policy='round-robin', retire_after=3):
+        """init.
+
+        Arguments:
+        - `factory`: called with a seed video ID, returns a tested Session
+        - `seed_videoIDs`: one seed video per slot
+        - `policy`: 'round-robin' or 'least-throttled'
+        - `retire_after`: consecutive throttled requests that retire a slot
+        """
+        if policy not in self.POLICIES:
+            raise ValueError('unknown session policy %s' % policy)
+        self._factory = factory
+        self._policy = policy
+        self._retire_after = retire_after
+        self._slots = [_Slot(i, v) for i, v in enumerate(seed_videoIDs)]
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def __len__(self):
+        """Return the number of slots with a usable session."""
+        return sum(1 for s in self._slots if s.session is not None)
+
+    def start(self):
+        """Open every slot's first session in parallel.
+
+        Raises the first error if no session at all could be opened.
+        """
+        errors = []
+
+        def open_slot(slot):
+            try:
+                self._install(slot, self._factory(slot.seed_videoID))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=open_slot, args=(s, )) for s in self._slots]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if not len(self):
+            raise errors[0]
+        for e in errors:
+            print("Could not open a session (%s)" % str(e))
+
+    def _install(self, slot, session):
+        session = session.in_slot(slot.index)
+        with self._lock:
+            slot.session = session
+            slot.strikes = 0
+            slot.retired = False
+            slot.refreshing = False
+
+    def get(self):
+        """Return the session the next request should use."""
+        with self._lock:
+            ready = [s for s in self._slots if s.session is not None and not s.retired]
+            if not ready:
+                ready = [s for s in self._slots if s.session is not None]
+
+            if self._policy == 'least-throttled':
+                slot = min(ready, key=lambda s: (s.last_throttled, s.last_used))
+            else:
+                slot = ready[self._next % len(ready)]
+                self._next += 1
+
+            slot.last_used = time.monotonic()
+            return slot.session
+
+    def report(self, session, throttled):
+        """Record whether a request made with the session was throttled.
+
+        Arguments:
+        - `session`: a Session returned by `get`
+        - `throttled`: True for a quota or invalid-request error
+        """
+        slot = self._slots[session.slot]
+        with self._lock:
+            if slot.session is not session:
+                return  # already replaced
+            if not throttled:
+                slot.strikes = 0
+                return
+            slot.last_throttled = time.monotonic()
+            slot.strikes += 1
+            if slot.strikes < self._retire_after or slot.refreshing:
+                return
+            slot.retired = True
+            slot.refreshing = True
+
+        t = threading.Thread(target=self._refresh, args=(slot, ))
+        t.daemon = True
+        t.start()
+
+    def _refresh(self, slot):
+        try:
+            self._install(slot, self._factory(slot.seed_videoID))
+        except Exception as e:
+            print("Keeping session %d, refresh failed (%s)" % (slot.index, str(e)))
+            with self._lock:
+                slot.strikes = 0
+                slot.retired = False
+                slot.refreshing = False
+
+    def refresh_all(self):
+        """Replace every slot's session one at a time.
+
+        Workers keep using a slot's current session until its replacement
+        has been opened and tested; on failure the current one is kept.
+        """
+        for slot in self._slots:
+            with self._lock:
+                if slot.refreshing:
+                    continue
+                slot.refreshing = True
+            self._refresh(slot)
@@ -2,18 +2,122 @@
 
 """The crawler to download YouTube video viewcount history."""
 
-# pylama:ignore=C901
+# pylama:ignore=C901,D213
 
 # Author: Honglin Yu <yuhonglin1986@gmail.com>
 # License: BSD 3 clause
 
+import array
 import datetime
+from collections.abc import Mapping
 from xml.etree import ElementTree
 import json
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+EPOCH = datetime.date(1970, 1, 1)
+MS_PER_DAY = 86400000
+NAN = float('nan')
+
+# The series in a response: (graph_data key, DailySeries attribute, dict key)
+SERIES = [
+    ('views', 'views', 'dailyViewcount'),
+    ('watch-time', 'watch_time', 'watchTime'),
+    ('shares', 'shares', 'numShare'),
+    ('subscribers', 'subscribers', 'numSubscriber'),
+]
+
+
+class DailySeries(Mapping):
+    """The daily statistics of one video.
+
+    Each series is an array with one value per day from `start`, days
+    missing from the response being 0 and null values NaN. Arrays are numpy arrays if numpy is
+    installed, otherwise `array.array`; a series not in the response is
+    None. For older callers this is also a read-only mapping with the keys
+    parseString used to return ('uploadDate', 'dailyViewcount', ...), whose
+    series values are lists.
+    """
+
+    __slots__ = ('start', 'views', 'watch_time', 'shares', 'subscribers')
+
+    def __init__(self, start, views, watch_time=None, shares=None, subscribers=None):
+        """init.
+
+        Arguments:
+        - `start`: the date of the first value
+        - `views`, `watch_time`, `shares`, `subscribers`: the daily arrays
+        """
+        self.start = start
+        self.views = views
+        self.watch_time = watch_time
+        self.shares = shares
+        self.subscribers = subscribers
+
+    def __len__(self):
+        """Return the number of keys in the dict view."""
+        return len(SERIES) + 1
+
+    def __iter__(self):
+        """Iterate over the keys of the dict view."""
+        yield 'uploadDate'
+        for src, attr, key in SERIES:
+            yield key
+
+    def __getitem__(self, key):
+        """Return a value of the dict view."""
+        if key == 'uploadDate':
+            return self.start
+        for src, attr, k in SERIES:
+            if k == key:
+                values = getattr(self, attr)
+                return [] if values is None else values.tolist()
+        raise KeyError(key)
+
+    def days(self):
+        """Return the number of days covered."""
+        return len(self.views)
+
+
+def _scatter(offsets, length, values):
+    """Place values at their day offsets in a zero-filled array.
+
+    Values at negative offsets (days before the first one) are dropped.
+    Null values become NaN, making the array float.
+    """
+    n = len(offsets)
+    if len(values) < n:
+        raise Exception("fewer values than days in the xml response")
+    values = values[:n]
+    nulls = any(v is None for v in values)
+    if nulls:
+        values = [NAN if v is None else v for v in values]
+    if numpy is not None:
+        values = numpy.asarray(values, dtype=numpy.float64 if nulls else None)
+        dtype = numpy.int64 if values.dtype.kind in 'iub' else numpy.float64
+        out = numpy.zeros(length, dtype=dtype)
+        keep = offsets >= 0
+        out[offsets[keep]] = values[keep]
+        return out
+
+    typecode = 'q' if all(isinstance(v, int) for v in values) else 'd'
+    out = array.array(typecode, bytes(length * array.array(typecode).itemsize))
+    for i, v in zip(offsets, values):
+        if i >= 0:
+            out[i] = v
+    return out
+
 
 def parseString(s):
-    """Crawler parser."""
+    """Crawler parser.
+
+    Return is a DailySeries, which also reads like the dict this used to
+    return.
+    """
     tree = ElementTree.fromstring(s)
     graphData = tree.find('graph_data')
 
@@ -22,62 +126,29 @@ def parseString(s):
 
     jsonDict = json.loads(graphData.text)
 
-    # get days
-    rawdate = [
-        datetime.date(1970, 1, 1) + datetime.timedelta(x/86400000)
-        for x in jsonDict['day']['data']
-    ]
-    uploadDate = rawdate[0]
-
-    # get views
-    try:
-        raw_views = jsonDict['views']['daily']['data']
-    except KeyError:
+    if 'views' not in jsonDict:
         raise Exception("can not get viewcount in the xml response")
 
-    tmp = uploadDate
-    viewcount = []
-    for i, j in enumerate(rawdate):
-        viewcount.append(raw_views[i])
-        viewcount += [0]*((j - tmp).days - 1)
-        tmp = j
-
-    # get watch time
-    watchTime = []
-    if 'watch-time' in jsonDict:
-        raw_wt = jsonDict['watch-time']['daily']['data']
-        tmp = uploadDate
-        for i, j in enumerate(rawdate):
-            watchTime.append(raw_wt[i])
-            watchTime += [0]*((j - tmp).days - 1)
-            tmp = j
-
-    # get shares
-    numShare = []
-    if 'shares' in jsonDict:
-        raw_ns = jsonDict['shares']['daily']['data']
-
-        tmp = uploadDate
-        for i, j in enumerate(rawdate):
-            numShare.append(raw_ns[i])
-            numShare += [0]*((j - tmp).days - 1)
-            tmp = j
-
-    # get numSubscriber
-    numSubscriber = []
-    if 'subscribers' in jsonDict:
-        raw_ns = jsonDict['subscribers']['daily']['data']
-
-        tmp = uploadDate
-        for i, j in enumerate(rawdate):
-            numSubscriber.append(raw_ns[i])
-            numSubscriber += [0]*((j - tmp).days - 1)
-            tmp = j
-
-    return {
-        'uploadDate': uploadDate,
-        'dailyViewcount': viewcount,
-        'watchTime': watchTime,
-        'numShare': numShare,
-        'numSubscriber': numSubscriber
-    }
+    # day numbers since the epoch, and offsets from the first one
+    raw_days = jsonDict['day']['data']
+    if not raw_days:
+        raise Exception("no days in the xml response")
+    if numpy is not None:
+        days = numpy.asarray(raw_days, dtype=numpy.int64) // MS_PER_DAY
+        offsets = days - days[0]
+        length = int(offsets.max()) + 1
+    else:
+        days = [int(x) // MS_PER_DAY for x in raw_days]
+        offsets = [d - days[0] for d in days]
+        length = max(offsets) + 1
+
+    series = {}
+    for src, attr, key in SERIES:
+        if src in jsonDict:
+            try:
+                raw = jsonDict[src]['daily']['data']
+            except KeyError:
+                raise Exception("can not get %s in the xml response" % src)
+            series[attr] = _scatter(offsets, length, raw)
+
+    return DailySeries(EPOCH + datetime.timedelta(days=int(days[0])), **series)